@@ -0,0 +1,369 @@
+import argparse
+import datetime
+import gzip
+import http.server
+import importlib.util
+import json
+import logging
+import os, sys
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+#Offline benchmarks for zap2it-GuideScrape.py: synthetic gracenote fixtures, a local stand-in server and per-phase timings
+SCRAPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "zap2it-GuideScrape.py")
+
+#name: (zip codes, guide days, channels per zip)
+SCENARIOS = {
+    "1x2": (1, 2, 40),
+    "2x7": (2, 7, 60),
+    "3x14": (3, 14, 80),
+    "5x14": (5, 14, 120),
+}
+ZIP_CODES = ["10001", "10002", "10003", "10004", "10005"]
+
+CATEGORIES = ["filter-news", "filter-sports", "filter-movie", "filter-family", "filter-reality", "filter-talk"]
+RATINGS = ["TV-G", "TV-PG", "TV-14", "TV-MA", None]
+DURATIONS = [30, 30, 30, 60, 60, 90, 120]
+
+#Fixtures
+def ZipChannels(zipCode, channelCount):
+    #Neighbouring zips share most of their channels, like overlapping OTA markets
+    offset = ZIP_CODES.index(zipCode) * (channelCount // 4) if zipCode in ZIP_CODES else 0
+    return [str(20000 + offset + number) for number in range(channelCount)]
+
+def ChannelEvents(channelId, windowStart, timespan):
+    #Deterministic schedule per channel and day; events straddle the window edges just like the real grid but never overlap
+    windowEnd = windowStart + timespan * 3600
+    dayStart = windowStart - (windowStart % (60 * 60 * 24))
+    events = []
+    while dayStart < windowEnd:
+        rng = random.Random("%s/%d" % (channelId, dayStart))
+        dayEnd = dayStart + 60 * 60 * 24
+        airTime = dayStart
+        while airTime < min(dayEnd, windowEnd):
+            duration = DURATIONS[rng.randrange(len(DURATIONS))]
+            endTime = min(dayEnd, airTime + duration * 60)
+            seed = rng.random()
+            if endTime > windowStart:
+                events.append((airTime, endTime, (endTime - airTime) // 60, seed))
+            airTime = endTime
+        dayStart = dayEnd
+    return events
+
+def FormatTime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%MZ")
+
+def GridFixture(zipCode, windowStart, timespan, channelCount):
+    channels = []
+    for channelNumber, channelId in enumerate(ZipChannels(zipCode, channelCount)):
+        events = []
+        for startTime, endTime, duration, seed in ChannelEvents(channelId, windowStart, timespan):
+            seriesNumber = int(seed * 5000)
+            episode = int(seed * 97) % 24
+            events.append({
+                "callSign": "",
+                "duration": str(duration),
+                "startTime": FormatTime(startTime),
+                "endTime": FormatTime(endTime),
+                "thumbnail": "p%d_b_v8_aa" % (seriesNumber * 7) if seed > 0.2 else None,
+                "channelNo": str(channelNumber + 2),
+                "filter": [CATEGORIES[seriesNumber % len(CATEGORIES)]] + ([CATEGORIES[1]] if seed > 0.8 else []),
+                "seriesId": "SH%08d" % seriesNumber,
+                "rating": RATINGS[seriesNumber % len(RATINGS)],
+                "flag": ["New"] if seed > 0.7 else (["Premiere"] if seed < 0.05 else []),
+                "tags": ["CC"] if seed > 0.1 else [],
+                "program": {
+                    "title": "Series %d & Friends" % seriesNumber,
+                    "id": "EP%08d%04d" % (seriesNumber, episode + 1),
+                    "tmsId": "EP%08d%04d" % (seriesNumber, episode + 1),
+                    "shortDesc": None if seed < 0.1 else ("Episode %d of series %d. " % (episode, seriesNumber)) * 4,
+                    "season": str(1 + seriesNumber % 9) if episode else None,
+                    "episode": str(episode) if episode else None,
+                    "episodeTitle": "Chapter <%d>" % episode if episode else None,
+                    "releaseYear": None,
+                    "isGeneric": "0"
+                }
+            })
+        channels.append({
+            "callSign": "W%03dTV" % channelNumber,
+            "affiliateName": "affiliate network %d" % (channelNumber % 12),
+            "affiliateCallSign": "null",
+            "channelId": channelId,
+            "channelNo": str(channelNumber + 2),
+            "id": channelId + "0",
+            "stationGenres": [],
+            "stationFilters": ["filter-news"],
+            "thumbnail": "//zap2it.tmsimg.com/stationLogos/s%s_h3_aa.png?w=55&h=55" % channelId,
+            "events": events
+        })
+    return {"channels": channels}
+
+def LoginFixture():
+    return {"token": "benchmark-token", "properties": {"2004": "lineupId"}}
+
+def ProvidersFixture(zipCode):
+    return {"Providers": [
+        {"type": "OTA", "name": "Local Over the Air Broadcast", "location": "", "headendId": "lineupId", "lineupId": "USA-lineupId-DEFAULT", "device": ""},
+        {"type": "CABLE", "name": "Benchmark Cable - Digital", "location": zipCode, "headendId": "BM%s" % zipCode, "lineupId": "USA-BM%s-DEFAULT" % zipCode, "device": "X"}
+    ]}
+
+#Local gracenote stand-in
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, address, channelCount=60, latency=0, maxTimespan=None):
+        super().__init__(address, StubHandler)
+        self.channelCount = channelCount
+        self.latency = latency
+        #Like gracenote, listings stop after maxTimespan hours whatever timespan was asked for
+        self.maxTimespan = maxTimespan
+        self.lock = threading.Lock()
+        self.ResetStats()
+    def ResetStats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "bytesSent": 0}
+    def count(self, size):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytesSent"] += size
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def log_message(self, format, *args):
+        pass
+    def SendJSON(self, data, status=200):
+        body = json.dumps(data).encode("utf8")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body))
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urllib.parse.urlsplit(self.path).path == "/api/user/login":
+            self.SendJSON(LoginFixture())
+        else:
+            self.SendJSON({"error": "not found"}, 404)
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/api/grid":
+            timespan = int(query["timespan"])
+            if self.server.maxTimespan is not None:
+                timespan = min(timespan, self.server.maxTimespan)
+            self.SendJSON(GridFixture(query["postalCode"], int(float(query["time"])), timespan, self.server.channelCount))
+        elif url.path.startswith("/gapzap_webapi/api/Providers/getPostalCodeProviders/"):
+            self.SendJSON(ProvidersFixture(url.path.split("/")[6]))
+        else:
+            self.SendJSON({"error": "not found"}, 404)
+
+def StartStub(port=0, channelCount=60, latency=0, maxTimespan=None):
+    server = StubServer(("127.0.0.1", port), channelCount, latency, maxTimespan)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+#Benchmark child: imports the scraper and times each phase of one BuildGuide
+def LoadScraper():
+    #Registered by name so render worker processes can unpickle the scraper's functions and records
+    if "zap2it_guidescrape" in sys.modules:
+        return sys.modules["zap2it_guidescrape"]
+    spec = importlib.util.spec_from_file_location("zap2it_guidescrape", SCRAPER)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["zap2it_guidescrape"] = module
+    spec.loader.exec_module(module)
+    return module
+
+#Spawned render workers import this file again rather than the scraper
+if __name__ == "__mp_main__":
+    LoadScraper()
+
+def PeakRSS():
+    #ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def CurrentRSS():
+    #Resident memory right now, unlike ru_maxrss which only ever grows; None where /proc is not available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class PhaseTimer():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+    def add(self, phase, seconds, size=0):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {"calls": 0, "seconds": 0.0, "bytes": 0, "rss": None})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["bytes"] += size
+            rss = CurrentRSS()
+            if rss is not None:
+                stats["rss"] = max(stats["rss"] or 0, rss)
+    def wrap(self, target, name, phase, measure=None):
+        method = getattr(target, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            self.add(phase, time.perf_counter() - start, measure(result) if measure is not None else 0)
+            return result
+        setattr(target, name, timed)
+
+def WriteConfig(workDir, baseUrl, zipCount, guideDays, options):
+    configFile = os.path.join(workDir, "zap2itconfig.ini")
+    with open(configFile, "w") as file:
+        file.write("[creds]\nUsername: benchmark@example.com\nPassword: benchmark\n")
+        file.write("[prefs]\ncountry: USA\nzipCode: %s\n" % json.dumps(ZIP_CODES[:zipCount]))
+        file.write("historicalGuideDays: 14\nguideDays: %d\nfavoriteChannels:\nlang: en\n" % guideDays)
+        file.write("[lineup]\nheadendId: lineupId\nlineupId: DFLT\ndevice: -\n")
+        file.write("[http]\nbaseUrl: %s\n" % baseUrl)
+        file.write("[fetch]\nmaxInFlight: %d\nrequestsPerSecond: 0\nburst: %d\n" % (options.max_in_flight, options.max_in_flight))
+        file.write("timespan: %s\n" % options.timespan)
+        file.write("[render]\nworkers: %d\n" % options.render_workers)
+        file.write("[cache]\nenabled: %s\n" % ("true" if options.cache else "false"))
+        file.write("[output]\nformats: %s\n" % options.formats)
+    return configFile
+
+def OutputBytes(guide):
+    return sum(os.path.getsize(guide.OutputFile(outputFormat)) for outputFormat in guide.outputFormats
+        if os.path.exists(guide.OutputFile(outputFormat)))
+
+def RunChild(options):
+    zipCount, guideDays, channelCount = SCENARIOS[options.child]
+    workDir = tempfile.mkdtemp(prefix="zap2it-bench-")
+    configFile = WriteConfig(workDir, options.base_url, zipCount, guideDays, options)
+    outputFile = os.path.join(workDir, "xmlguide.xmltv")
+
+    scraper = LoadScraper()
+    logging.getLogger().setLevel(logging.WARNING)
+    guide = scraper.Zap2ItGuideScrape(configFile, outputFile)
+    timer = PhaseTimer()
+    timer.wrap(guide, "Authenticate", "authenticate")
+    timer.wrap(guide, "GetData", "fetch+parse")
+    timer.wrap(guide, "BuildChannelXML", "render", len)
+    timer.wrap(guide, "BuildEventXmL", "render", len)
+    timer.wrap(guide, "ChannelRecord", "render")
+    timer.wrap(guide, "ProgrammeRecord", "render")
+    timer.wrap(guide, "WriteGuide", "write", lambda result: OutputBytes(guide))
+    timer.wrap(guide, "CopyHistorical", "historical")
+    timer.wrap(guide, "CleanHistorical", "cleanup")
+
+    #The scraper prints progress to stdout, so the report goes to a file
+    start = time.perf_counter()
+    guide.BuildGuide()
+    wall = time.perf_counter() - start
+    result = {
+        "scenario": options.child,
+        "renderWorkers": options.render_workers,
+        "wall": wall,
+        "requests": guide.session.http.stats["requests"],
+        "bytesOnWire": guide.session.http.stats["bytesOnWire"],
+        "outputBytes": OutputBytes(guide),
+        "peakRSS": PeakRSS(),
+        "programmes": len(guide.dedup.events),
+        #BuildEventXmL runs in other processes with render workers, so render+write comes from the scraper's own timings
+        "renderWrite": guide.phaseTimes.get("render", 0) + guide.phaseTimes.get("write", 0),
+        "phases": timer.phases
+    }
+    with open(options.result, "w") as file:
+        json.dump(result, file)
+    shutil.rmtree(workDir, ignore_errors=True)
+
+#Parent: one fresh process per scenario so peak RSS is not shared between runs
+def RunScenario(name, options, renderWorkers):
+    zipCount, guideDays, channelCount = SCENARIOS[name]
+    server = StartStub(0, channelCount, options.latency / 1000.0, options.max_timespan)
+    resultFile = tempfile.mktemp(prefix="zap2it-bench-", suffix=".json")
+    command = [sys.executable, os.path.abspath(__file__), "--child", name, "--result", resultFile,
+        "--base-url", "http://127.0.0.1:%d" % server.server_address[1],
+        "--max-in-flight", str(options.max_in_flight), "--formats", options.formats,
+        "--timespan", options.timespan, "--render-workers", str(renderWorkers)]
+    if options.cache:
+        command.append("--cache")
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(resultFile) as file:
+            result = json.load(file)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(resultFile):
+            os.remove(resultFile)
+    result["stubRequests"] = server.stats["requests"]
+    return result
+
+def PrintResult(result):
+    print("%s: %.2fs wall, %d requests (%d bytes on wire), %d output bytes, peak RSS %.1f MiB" % (
+        result["scenario"], result["wall"], result["requests"], result["bytesOnWire"],
+        result["outputBytes"], result["peakRSS"] / 1048576.0))
+    print("  render+write on the main process with %d render workers: %.3fs for %d programmes (%.0f programmes/s)" % (
+        result["renderWorkers"], result["renderWrite"], result["programmes"],
+        result["programmes"] / max(result["renderWrite"], 1e-9)))
+    print("  %-14s %8s %10s %12s %12s" % ("phase", "calls", "seconds", "bytes", "RSS MiB"))
+    for phase, stats in result["phases"].items():
+        rss = "%.1f" % (stats["rss"] / 1048576.0) if stats["rss"] is not None else "-"
+        print("  %-14s %8d %10.3f %12d %12s" % (phase, stats["calls"], stats["seconds"], stats["bytes"], rss))
+
+def main():
+    parser = argparse.ArgumentParser("Offline benchmarks for zap2it-GuideScrape.py")
+    parser.add_argument("-s","--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (zips x days), may be repeated; default all")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds of latency injected into every stub response")
+    parser.add_argument("--max-in-flight", type=int, default=1, help="[fetch] maxInFlight for the scraper")
+    parser.add_argument("--cache", action="store_true", help="Leave the grid cache enabled")
+    parser.add_argument("--timespan", default="3", help="[fetch] timespan for the scraper: hours per grid request, or auto")
+    parser.add_argument("--max-timespan", type=int, help="Hours after which the stand-in cuts grid responses short")
+    parser.add_argument("--render-workers", type=int, action="append", help="[render] workers for the scraper, may be repeated to compare; default 0 (serial)")
+    parser.add_argument("--formats", default="xmltv", help="[output] formats for the scraper, e.g. \"xmltv, jsonl, sqlite\"")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Only run the gracenote stand-in on PORT")
+    parser.add_argument("--channels", type=int, default=60, help="Channels per zip when using --serve")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.render_workers is None:
+        options.render_workers = [0]
+    if options.child is not None:
+        options.render_workers = options.render_workers[-1]
+        RunChild(options)
+        return
+    if options.serve is not None:
+        server = StubServer(("127.0.0.1", options.serve), options.channels, options.latency / 1000.0, options.max_timespan)
+        print("Serving gracenote fixtures at http://127.0.0.1:%d" % options.serve)
+        server.serve_forever()
+        return
+
+    results = []
+    for name in options.scenario or list(SCENARIOS):
+        serial = None
+        for renderWorkers in options.render_workers:
+            result = RunScenario(name, options, renderWorkers)
+            PrintResult(result)
+            if serial is None:
+                serial = result
+            else:
+                print("  %.2fx render+write throughput, %.2fx wall time of %d render workers" % (
+                    serial["renderWrite"] / max(result["renderWrite"], 1e-9), serial["wall"] / result["wall"], serial["renderWorkers"]))
+            results.append(result)
+    if options.json is not None:
+        with open(options.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,25 @@
 import configparser
 import json
+import http.client
+import gzip, zlib, io
+import hashlib
+import base64
+import dataclasses
+import re
+import email.utils
 import urllib.parse, urllib.request, urllib.error
-import time, datetime
-import xml.dom.minidom
-import sys, os, argparse
+import time, datetime, random
+import sys, os, argparse, shutil
 import logging
+import threading
+import concurrent.futures
+import multiprocessing
+import itertools
+import bisect, array, collections, calendar
+import xml.etree.ElementTree as ElementTree
+import xml.sax.saxutils
+import sqlite3
+import contextlib
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,14 +33,1188 @@ ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
-#Use Globals to track state of the guide
-ADDED_CHANNELS = []
-ADDED_EVENTS = []
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class RateLimiter():
+    #Token bucket shared by every thread that talks to gracenote; slows down when gracenote pushes back
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.current = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    wait = self.pausedUntil - now
+                elif self.current <= 0:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.current)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.current
+            time.sleep(wait)
+    def throttle(self, delay):
+        #429/5xx: every thread waits out the delay, then runs at half the pace until requests succeed again
+        with self.lock:
+            now = time.monotonic()
+            self.pausedUntil = max(self.pausedUntil, now + delay)
+            self.current = max(0.05, self.current / 2) if self.current > 0 else 1.0
+            self.tokens = 0
+            self.updated = max(now, self.pausedUntil)
+    def recover(self):
+        with self.lock:
+            if self.current == self.rate:
+                return
+            self.current *= 1.1
+            if self.rate > 0 and self.current >= self.rate:
+                self.current = self.rate
+            elif self.rate <= 0 and self.current >= 10:
+                self.current = self.rate
+
+class HttpClient():
+    #Keep-alive connection pool for gracenote with transparent response decompression
+    def __init__(self, timeout=30, maxIdle=4):
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.acceptEncoding = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+        self.ResetStats()
+    def ResetStats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "handshakes": 0, "bytesOnWire": 0, "bytesDecoded": 0}
+    def LogStats(self):
+        stats = self.stats
+        saved = 0
+        if stats["bytesDecoded"] > 0:
+            saved = max(0, 100 - (100 * stats["bytesOnWire"] // stats["bytesDecoded"]))
+        logging.info("HTTP: %d requests over %d connections, %d bytes on wire for %d bytes of content (%d%% saved)",
+            stats["requests"], stats["handshakes"], stats["bytesOnWire"], stats["bytesDecoded"], saved)
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+    def connect(self, scheme, host):
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        self.count("handshakes")
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout, context=ssl_context), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+    def release(self, scheme, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                return
+        conn.close()
+    def decode(self, body, encoding):
+        encoding = (encoding or "").strip().lower()
+        if encoding == "gzip":
+            return gzip.decompress(body)
+        if encoding == "deflate":
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        if encoding == "br" and brotli is not None:
+            return brotli.decompress(body)
+        return body
+    def open(self, request, redirects=5):
+        #Drop-in for urllib.request.urlopen(request).read() that raises the same urllib errors
+        url = request.full_url
+        method = request.get_method()
+        body = request.data
+        headers = dict(request.header_items())
+        headers["Accept-Encoding"] = self.acceptEncoding
+        headers["Connection"] = "keep-alive"
+        if body is not None and "Content-type" not in headers:
+            headers["Content-type"] = "application/x-www-form-urlencoded"
+        for attempt in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            response, raw = self.send(parts.scheme, parts.netloc, method, path, body, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                if response.status == 303:
+                    method, body = "GET", None
+                continue
+            data = self.decode(raw, response.getheader("Content-Encoding"))
+            self.count("bytesDecoded", len(data))
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(data))
+            return data
+        raise urllib.error.URLError("Too many redirects: " + request.full_url)
+    def send(self, scheme, host, method, path, body, headers):
+        while True:
+            conn, reused = self.connect(scheme, host)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                #A pooled connection may have been dropped by the server while idle
+                if reused:
+                    continue
+                raise urllib.error.URLError(e)
+            self.count("requests")
+            self.count("bytesOnWire", len(raw))
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(scheme, host, conn)
+            return response, raw
+
+def WindowKey(lineupId, headendId, device, country, zipCode, windowStart, timespan):
+    #Identifies one /api/grid response, whichever lineup profile asked for it
+    keyData = json.dumps([lineupId, headendId, device, country, zipCode, int(windowStart), timespan])
+    return hashlib.sha256(keyData.encode("utf8")).hexdigest()
+
+class GridCache():
+    #Content addressed store of raw /api/grid responses, expired by how far ahead the window is
+    def __init__(self, cacheDir, nearTermHours=24, nearTermTTL=3, farTermTTL=48):
+        self.cacheDir = cacheDir
+        self.nearTermSeconds = nearTermHours * 3600
+        self.nearTermTTL = nearTermTTL * 3600
+        self.farTermTTL = farTermTTL * 3600
+        self.lock = threading.Lock()
+        self.ResetStats()
+    def ResetStats(self):
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "refreshed": 0, "bytes": 0}
+    def LogStats(self):
+        stats = self.stats
+        logging.info("Cache: %d hits (%d bytes), %d misses, %d expired, %d forced refreshes",
+            stats["hits"], stats["bytes"], stats["misses"], stats["expired"], stats["refreshed"])
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+    def path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key + ".json.gz")
+    def ttl(self, windowStart):
+        if windowStart < time.time() + self.nearTermSeconds:
+            return self.nearTermTTL
+        return self.farTermTTL
+    def get(self, key, windowStart):
+        fileName = self.path(key)
+        try:
+            age = time.time() - os.stat(fileName).st_mtime
+            if age >= self.ttl(windowStart):
+                self.count("expired")
+                return None
+            with open(fileName, "rb") as file:
+                data = gzip.decompress(file.read())
+        except (OSError, EOFError, zlib.error):
+            self.count("misses")
+            return None
+        self.count("hits")
+        self.count("bytes", len(data))
+        return data
+    def put(self, key, data):
+        fileName = self.path(key)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        tempName = "%s.%d.%d.tmp" % (fileName, os.getpid(), threading.get_ident())
+        data = gzip.compress(data, 6)
+        try:
+            file = open(tempName, "wb")
+        except FileNotFoundError:
+            #The subdirectory was removed as empty in the meantime
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            file = open(tempName, "wb")
+        with file:
+            file.write(data)
+        os.replace(tempName, fileName)
+    def remove(self, key):
+        fileName = self.path(key)
+        try:
+            os.remove(fileName)
+            os.rmdir(os.path.dirname(fileName))
+        except OSError:
+            pass
+    def prune(self):
+        #Anything older than the longest TTL can never be served again
+        maxAge = max(self.nearTermTTL, self.farTermTTL)
+        if not os.path.isdir(self.cacheDir):
+            return
+        for dirPath, dirNames, fileNames in os.walk(self.cacheDir, topdown=False):
+            for item in fileNames:
+                fileName = os.path.join(dirPath, item)
+                try:
+                    if time.time() - os.stat(fileName).st_mtime >= maxAge:
+                        os.remove(fileName)
+                except OSError:
+                    pass
+            if dirPath != self.cacheDir:
+                try:
+                    os.rmdir(dirPath)
+                except OSError:
+                    pass
+
+def ArtId(url):
+    #Stable id for an image URL, so guides can point at /art/<id>.jpg before the image is fetched
+    return hashlib.sha1(url.encode("utf8")).hexdigest()[:24]
+
+def ImageType(data):
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+class ArtCache():
+    #Channel logos and programme artwork for --web mode: files named by their sha256, evicted least recently used over maxSize
+    def __init__(self, artDir, maxSize, fetchers=4, timeout=30):
+        self.artDir = artDir
+        self.maxSize = maxSize
+        self.fetchers = fetchers
+        self.http = HttpClient(timeout, fetchers)
+        self.lock = threading.Lock()
+        #id: [url, last referenced by a guide]
+        self.urls = {}
+        #id: [sha256, content type]
+        self.art = {}
+        #sha256: size, least recently used first
+        self.blobs = collections.OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "fetched": 0, "failed": 0, "evicted": 0}
+        self.load()
+    def LogStats(self):
+        stats = self.stats
+        logging.info("Artwork: %d images (%d bytes) cached, %d hits, %d misses, %d fetched, %d failed, %d evicted",
+            len(self.blobs), self.size, stats["hits"], stats["misses"], stats["fetched"], stats["failed"], stats["evicted"])
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+    def path(self, digest):
+        return os.path.join(self.artDir, digest[:2], digest)
+    def load(self):
+        try:
+            with open(os.path.join(self.artDir, "index.json"), "r", encoding="utf8") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return
+        for digest, size in index.get("blobs", []):
+            if os.path.exists(self.path(digest)):
+                self.blobs[digest] = size
+                self.size += size
+        self.urls = index.get("urls", {})
+        self.art = {artId: entry for artId, entry in index.get("art", {}).items() if entry[0] in self.blobs}
+        #maxMB may have been lowered since the last run
+        with self.lock:
+            evicted = self.evict()
+        self.remove(evicted)
+    def save(self):
+        #URLs no guide has referenced for a month are forgotten; their images age out of the LRU
+        cutoff = time.time() - 30 * 24 * 60 * 60
+        with self.lock:
+            self.urls = {artId: entry for artId, entry in self.urls.items() if entry[1] >= cutoff}
+            self.art = {artId: entry for artId, entry in self.art.items() if artId in self.urls}
+            data = json.dumps({"urls": self.urls, "art": self.art, "blobs": list(self.blobs.items())})
+        fileName = os.path.join(self.artDir, "index.json")
+        tempName = "%s.%d.tmp" % (fileName, os.getpid())
+        try:
+            os.makedirs(self.artDir, exist_ok=True)
+            with open(tempName, "w", encoding="utf8") as file:
+                file.write(data)
+            os.replace(tempName, fileName)
+        except OSError as e:
+            logging.warning("Could not save the artwork index: %s", e)
+    def Register(self, urls):
+        now = time.time()
+        with self.lock:
+            for url in urls:
+                self.urls[ArtId(url)] = [url, now]
+    def Url(self, artId):
+        with self.lock:
+            entry = self.urls.get(artId)
+        return entry[0] if entry is not None else None
+    def Prefetch(self, urls):
+        #Every image the new guide points at, a few at a time
+        self.Register(urls)
+        with self.lock:
+            missing = [url for url in urls if ArtId(url) not in self.art]
+        if missing:
+            logging.info("Fetching %d of %d images", len(missing), len(urls))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetchers) as pool:
+                list(pool.map(self.fetch, missing))
+        self.save()
+        self.LogStats()
+    def fetch(self, url):
+        request = urllib.request.Request(url, data=None, headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'})
+        try:
+            data = self.http.open(request)
+            contentType = ImageType(data)
+            if contentType is None:
+                raise ValueError("not an image")
+        except (urllib.error.URLError, ValueError, OSError, EOFError, zlib.error) as e:
+            self.count("failed")
+            logging.info("Could not fetch artwork %s: %s", url, e)
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        fileName = self.path(digest)
+        try:
+            if not os.path.exists(fileName):
+                os.makedirs(os.path.dirname(fileName), exist_ok=True)
+                tempName = "%s.%d.%d.tmp" % (fileName, os.getpid(), threading.get_ident())
+                with open(tempName, "wb") as file:
+                    file.write(data)
+                os.replace(tempName, fileName)
+        except OSError as e:
+            logging.warning("Could not store artwork %s: %s", url, e)
+            return data, digest, contentType
+        self.count("fetched")
+        with self.lock:
+            self.art[ArtId(url)] = [digest, contentType]
+            if digest in self.blobs:
+                self.blobs.move_to_end(digest)
+            else:
+                self.blobs[digest] = len(data)
+                self.size += len(data)
+            evicted = self.evict()
+        self.remove(evicted)
+        return data, digest, contentType
+    def evict(self):
+        #Called with the lock held; the newest image always stays
+        evicted = []
+        while self.size > self.maxSize and len(self.blobs) > 1:
+            digest, size = self.blobs.popitem(last=False)
+            self.size -= size
+            evicted.append(digest)
+        if evicted:
+            gone = set(evicted)
+            self.art = {artId: entry for artId, entry in self.art.items() if entry[0] not in gone}
+            self.stats["evicted"] += len(evicted)
+        return evicted
+    def remove(self, digests):
+        for digest in digests:
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+    def Get(self, artId):
+        #(data, sha256, content type) from disk, fetched from the original URL on a miss; None for unknown ids
+        with self.lock:
+            entry = self.art.get(artId)
+            if entry is not None and entry[0] in self.blobs:
+                self.blobs.move_to_end(entry[0])
+        if entry is not None:
+            try:
+                with open(self.path(entry[0]), "rb") as file:
+                    data = file.read()
+                self.count("hits")
+                return data, entry[0], entry[1]
+            except OSError:
+                pass
+        self.count("misses")
+        url = self.Url(artId)
+        if url is None:
+            return None
+        return self.fetch(url)
+
+def XMLEscape(data):
+    return data.replace("&","&amp;").replace("<","&lt;").replace("\"","&quot;").replace(">","&gt;")
+
+def XMLElement(name, attributes=None, data=None, depth=2):
+    #One pretty printed line: <name attr="..">data</name> or <name attr=".."/>
+    tag = "\t" * depth + "<" + name
+    if attributes is not None:
+        for attrName, attrValue in attributes.items():
+            tag += ' ' + attrName + '="' + XMLEscape(attrValue) + '"'
+    if data is None:
+        return tag + "/>\n"
+    return tag + ">" + XMLEscape(str(data)) + "</" + name + ">\n"
+
+class XMLTVWriter():
+    #Streams <channel>/<programme> fragments (optionally gzipped) to a temp file that atomically replaces the guide on close
+    def __init__(self, fileName, rootAttributes, compress=False):
+        self.fileName = fileName
+        self.tempName = fileName + ".tmp"
+        self.raw = open(self.tempName, "wb")
+        self.gzip = None
+        if compress:
+            #A fixed mtime keeps identical guides byte identical
+            self.gzip = gzip.GzipFile(filename=os.path.basename(fileName).removesuffix(".gz"), mode="wb", compresslevel=6, fileobj=self.raw, mtime=0)
+        self.file = io.TextIOWrapper(self.gzip or self.raw, encoding="utf8")
+        self.file.write('<?xml version="1.0" ?>\n')
+        self.file.write(XMLElement("tv", rootAttributes, depth=0)[:-3] + ">\n")
+    def AddChannels(self, xml, records):
+        self.file.write(xml)
+    def AddProgrammes(self, xml, records):
+        self.file.write(xml)
+    def close(self):
+        self.file.write("</tv>\n")
+        self.file.flush()
+        self.file.detach()
+        if self.gzip is not None:
+            self.gzip.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.tempName, self.fileName)
+    def abort(self):
+        self.file.close()
+        self.raw.close()
+        try:
+            os.remove(self.tempName)
+        except OSError:
+            pass
+
+class JSONLinesWriter():
+    #One JSON object per channel and programme, in guide order, for tools that do not speak XMLTV
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.tempName = fileName + ".tmp"
+        self.file = open(self.tempName, "w", encoding="utf8")
+    def AddChannels(self, xml, records):
+        for record in records:
+            self.file.write(json.dumps(dict(type="channel", **record)) + "\n")
+    def AddProgrammes(self, xml, records):
+        for record in records:
+            self.file.write(json.dumps(dict(type="programme", **record)) + "\n")
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tempName, self.fileName)
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tempName)
+        except OSError:
+            pass
+
+class SQLiteWriter():
+    #Channels and programmes in a fresh database; indexes are created once all rows are in
+    channelColumns = ("id", "number", "callSign", "name", "icon")
+    programmeColumns = ("channel", "start", "stop", "title", "subTitle", "description", "duration", "season", "episode",
+        "categories", "flags", "tags", "rating", "seriesId", "programId", "icon")
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.tempName = fileName + ".tmp"
+        if os.path.exists(self.tempName):
+            os.remove(self.tempName)
+        self.db = sqlite3.connect(self.tempName)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE channels (id TEXT PRIMARY KEY, number TEXT, callSign TEXT, name TEXT, icon TEXT)")
+        self.db.execute("CREATE TABLE programmes (channel TEXT NOT NULL, start INTEGER NOT NULL, stop INTEGER NOT NULL, "
+            "title TEXT, subTitle TEXT, description TEXT, duration INTEGER, season TEXT, episode TEXT, "
+            "categories TEXT, flags TEXT, tags TEXT, rating TEXT, seriesId TEXT, programId TEXT, icon TEXT)")
+        self.times = {}
+    def time(self, value):
+        timestamp = self.times.get(value)
+        if timestamp is None:
+            timestamp = int(GridTimestamp(value))
+            self.times[value] = timestamp
+        return timestamp
+    def AddChannels(self, xml, records):
+        self.db.executemany("INSERT OR IGNORE INTO channels VALUES (?,?,?,?,?)",
+            [tuple(record[column] for column in self.channelColumns) for record in records])
+    def AddProgrammes(self, xml, records):
+        rows = []
+        for record in records:
+            row = dict(record, start=self.time(record["start"]), stop=self.time(record["stop"]), duration=int(record["duration"]),
+                categories=json.dumps(record["categories"]), flags=json.dumps(record["flags"]), tags=json.dumps(record["tags"]))
+            rows.append(tuple(row[column] for column in self.programmeColumns))
+        self.db.executemany("INSERT INTO programmes VALUES (%s)" % ",".join("?" * len(self.programmeColumns)), rows)
+    def close(self):
+        self.db.execute("CREATE INDEX programmes_channel_start ON programmes (channel, start)")
+        self.db.execute("CREATE INDEX programmes_start ON programmes (start)")
+        self.db.commit()
+        self.db.close()
+        os.replace(self.tempName, self.fileName)
+    def abort(self):
+        self.db.close()
+        try:
+            os.remove(self.tempName)
+        except OSError:
+            pass
+
+class DedupIndex():
+    #What has already been written during one build, plus how much each zip repeated
+    def __init__(self):
+        self.channels = set()
+        self.events = set()
+        self.duplicates = {}
+    def count(self, zipCode, kind):
+        zipCounts = self.duplicates.setdefault(zipCode, {"channels": 0, "events": 0})
+        zipCounts[kind] += 1
+    def AddChannel(self, channelId, zipCode=None):
+        if channelId in self.channels:
+            self.count(zipCode, "channels")
+            return False
+        self.channels.add(channelId)
+        return True
+    def AddEvent(self, channelId, startTime, endTime, zipCode=None):
+        key = (channelId, startTime, endTime)
+        if key in self.events:
+            self.count(zipCode, "events")
+            return False
+        self.events.add(key)
+        return True
+    def LogStats(self):
+        logging.info("Guide contains %d channels and %d programmes", len(self.channels), len(self.events))
+        for zipCode, zipCounts in self.duplicates.items():
+            logging.info("Duplicates suppressed for %s: %d channels, %d programmes", zipCode, zipCounts["channels"], zipCounts["events"])
+
+def Intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+class Channel():
+    #One lineup entry, parsed once from the grid JSON
+    __slots__ = ("channelId", "channelNo", "callSign", "affiliateName", "thumbnail", "programmes")
+    def __init__(self, channelId, channelNo, callSign, affiliateName, thumbnail, programmes):
+        self.channelId = channelId
+        self.channelNo = channelNo
+        self.callSign = callSign
+        self.affiliateName = affiliateName
+        self.thumbnail = thumbnail
+        self.programmes = programmes
+    @classmethod
+    def FromJSON(cls, channel):
+        channelId = Intern(channel["channelId"])
+        return cls(channelId,
+            Intern(channel["channelNo"]),
+            Intern(channel["callSign"]),
+            Intern(channel["affiliateName"]),
+            Intern(channel["thumbnail"]),
+            [Programme.FromJSON(event, channelId) for event in channel["events"]])
+
+class Programme():
+    #One airing; repeated values (times, ratings, categories, series ids) are interned
+    __slots__ = ("channelId", "startTime", "endTime", "duration", "title", "episodeTitle", "shortDesc",
+        "thumbnail", "seriesId", "programId", "season", "episode", "categories", "flags", "tags", "rating")
+    def __init__(self, channelId, startTime, endTime, duration, title, episodeTitle, shortDesc,
+            thumbnail, seriesId, programId, season, episode, categories, flags, tags, rating):
+        self.channelId = channelId
+        self.startTime = startTime
+        self.endTime = endTime
+        self.duration = duration
+        self.title = title
+        self.episodeTitle = episodeTitle
+        self.shortDesc = shortDesc
+        self.thumbnail = thumbnail
+        self.seriesId = seriesId
+        self.programId = programId
+        self.season = season
+        self.episode = episode
+        self.categories = categories
+        self.flags = flags
+        self.tags = tags
+        self.rating = rating
+    def __reduce__(self):
+        #Sent to render workers as plain constructor arguments
+        return (Programme, tuple(getattr(self, name) for name in self.__slots__))
+    @classmethod
+    def FromJSON(cls, event, channelId):
+        program = event["program"]
+        season = program.get("season")
+        episode = program.get("episode")
+        return cls(channelId,
+            Intern(event["startTime"]),
+            Intern(event["endTime"]),
+            Intern(str(event["duration"])),
+            Intern(program["title"]),
+            program["episodeTitle"],
+            program["shortDesc"],
+            event["thumbnail"],
+            Intern(event["seriesId"]),
+            program["id"],
+            Intern(str(season)) if season is not None else None,
+            Intern(str(episode)) if episode is not None else None,
+            tuple(Intern(category.replace('filter-','')) for category in event["filter"]),
+            tuple(Intern(flag) for flag in event["flag"]),
+            tuple(Intern(tag) for tag in event["tags"]),
+            Intern(event["rating"]))
+
+#Render workers: each process gets a copy of the scraper's render settings once, then renders whole windows
+RENDER_GUIDE = None
+
+def InitRenderWorker(guide):
+    global RENDER_GUIDE
+    RENDER_GUIDE = guide
+
+def RenderProgrammes(programmes):
+    return "".join([RENDER_GUIDE.BuildEventXmL(programme) for programme in programmes])
+
+def ParseGrid(response, wantChannel=None):
+    #The raw page is dropped as soon as the records are built; unwanted channels never get their events parsed
+    return [Channel.FromJSON(channel) for channel in json.loads(response)["channels"]
+        if wantChannel is None or wantChannel(channel["channelId"])]
+
+def GridTimestamp(value):
+    #"2026-10-16T21:00Z" to epoch seconds
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def TruncatedChannels(channels, windowStart, timespan, baseTimespan):
+    #A channel listed through the first baseTimespan hours of a window but not to its end was cut short by gracenote
+    baseEnd = windowStart + 60 * 60 * baseTimespan
+    windowEnd = windowStart + 60 * 60 * timespan
+    truncated = []
+    for channel in channels:
+        if not channel.programmes:
+            continue
+        lastEnd = max(GridTimestamp(programme.endTime) for programme in channel.programmes)
+        if baseEnd <= lastEnd < windowEnd:
+            truncated.append(channel.channelId)
+    return truncated
+
+def MergeWindows(windows):
+    #Consecutive smaller windows stitched into one; programmes straddling the edges are dropped later by the dedup index
+    merged = {}
+    for channels in windows:
+        for channel in channels:
+            if channel.channelId in merged:
+                merged[channel.channelId].programmes.extend(channel.programmes)
+            else:
+                merged[channel.channelId] = channel
+    return list(merged.values())
+
+def BoundedMap(pool, fn, items, ahead):
+    #Like pool.map, but at most `ahead` results are being fetched or waiting to be consumed at once
+    items = iter(items)
+    pending = collections.deque(pool.submit(fn, item) for item in itertools.islice(items, ahead))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.submit(fn, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+def ParseBool(value):
+    return str(value).strip().lower() in ("true","yes","1","on")
+
+def ParseList(value):
+    #Accepts the JSON list format ([1, 2]) as well as a plain comma separated list
+    value = (value or "").strip()
+    if value == "":
+        return ()
+    try:
+        items = json.loads(value)
+        if not isinstance(items,list):
+            items = [items]
+    except json.JSONDecodeError:
+        items = value.strip("[]").split(",")
+    return tuple(str(item).strip() for item in items if str(item).strip() != "")
+
+@dataclasses.dataclass(frozen=True)
+class Settings():
+    #Every config value, resolved once from the environment, the ini file and the defaults
+    username: str
+    password: str
+    country: str
+    lang: str
+    zipCodes: tuple
+    guideDays: int
+    historicalGuideDays: int
+    favoriteChannels: frozenset
+    excludeChannels: frozenset
+    lineupId: str
+    headendId: str
+    device: str
+    maxInFlight: int
+    requestsPerSecond: float
+    burst: int
+    baseUrl: str
+    timeout: float
+    incremental: bool
+    refreshInterval: float
+    nearTermRefresh: float
+    cacheEnabled: bool
+    cacheDir: str
+    cacheNearTermHours: float
+    cacheNearTermTTL: float
+    cacheFarTermTTL: float
+    lineups: tuple
+    lineupStagger: float
+    stateFile: str
+    tokenTTL: float
+    coalesceZipCodes: bool
+    outputFormats: tuple
+    historyFormat: str
+    retries: int
+    retryBackoff: float
+    retryMaxBackoff: float
+    maxMissing: float
+    partialRetry: float
+    checkpointDir: str
+    checkpointHours: float
+    timespan: int
+    autoTimespan: bool
+    maxTimespan: int
+    renderWorkers: int
+    artEnabled: bool
+    artDir: str
+    artMaxSize: int
+    artFetchers: int
+    artUrl: str
+
+    @classmethod
+    def Load(cls, getValue, outputFile):
+        try:
+            guideDays = int(getValue("prefs","guideDays", fallback="14"))
+        except ValueError:
+            logging.info("guideDays not in config. using default: 14")
+            guideDays = 14
+        timespan = getValue("fetch","timespan", fallback="3").strip().lower()
+        renderWorkers = getValue("render","workers", fallback="0").strip().lower()
+        return cls(
+            username=getValue("creds","username"),
+            password=getValue("creds","password"),
+            country=getValue("prefs","country"),
+            lang=getValue("prefs","lang"),
+            zipCodes=ParseList(getValue("prefs","zipCode", fallback="")),
+            guideDays=guideDays,
+            historicalGuideDays=int(getValue("prefs","historicalGuideDays", fallback="30")),
+            favoriteChannels=frozenset(ParseList(getValue("prefs","favoriteChannels", fallback=""))),
+            excludeChannels=frozenset(ParseList(getValue("prefs","excludeChannels", fallback=""))),
+            lineupId=getValue("lineup","lineupId"),
+            headendId=getValue("lineup","headendId", fallback='lineupId'),
+            device=getValue("lineup","device", fallback='-'),
+            #Fetch tuning: defaults match the old serial loop (one request every 5 seconds)
+            maxInFlight=max(1, int(getValue("fetch","maxInFlight", fallback="1"))),
+            requestsPerSecond=float(getValue("fetch","requestsPerSecond", fallback="0.2")),
+            burst=int(getValue("fetch","burst", fallback="1")),
+            baseUrl=getValue("http","baseUrl", fallback="https://tvlistings.gracenote.com").rstrip("/"),
+            timeout=float(getValue("http","timeout", fallback="30")),
+            incremental=ParseBool(getValue("refresh","incremental", fallback="false")),
+            refreshInterval=float(getValue("refresh","interval", fallback="60")) * 60,
+            nearTermRefresh=float(getValue("refresh","nearTermHours", fallback="6")) * 3600,
+            cacheEnabled=ParseBool(getValue("cache","enabled", fallback="true")),
+            cacheDir=getValue("cache","dir", fallback=os.path.join(os.path.dirname(os.path.abspath(outputFile)), ".zap2itcache")),
+            cacheNearTermHours=float(getValue("cache","nearTermHours", fallback="24")),
+            cacheNearTermTTL=float(getValue("cache","nearTermTTL", fallback="3")),
+            cacheFarTermTTL=float(getValue("cache","farTermTTL", fallback="48")),
+            lineups=ParseList(getValue("prefs","lineups", fallback="")),
+            lineupStagger=float(getValue("prefs","lineupStagger", fallback="30")),
+            stateFile=getValue("state","file", fallback=os.path.join(os.path.dirname(os.path.abspath(outputFile)), ".zap2itstate.json")),
+            tokenTTL=float(getValue("creds","tokenTTL", fallback="12")) * 3600,
+            coalesceZipCodes=ParseBool(getValue("prefs","coalesceZipCodes", fallback="true")),
+            outputFormats=ParseList(getValue("output","formats", fallback="xmltv")),
+            historyFormat=getValue("output","history", fallback="xmltv").strip(),
+            retries=int(getValue("fetch","retries", fallback="4")),
+            retryBackoff=float(getValue("fetch","retryBackoff", fallback="2")),
+            retryMaxBackoff=float(getValue("fetch","retryMaxBackoff", fallback="120")),
+            maxMissing=float(getValue("fetch","maxMissingPercent", fallback="10")),
+            partialRetry=float(getValue("fetch","partialRetry", fallback="15")) * 60,
+            checkpointDir=getValue("checkpoint","dir", fallback=os.path.join(os.path.dirname(os.path.abspath(outputFile)), ".zap2itcheckpoint")),
+            checkpointHours=float(getValue("checkpoint","hours", fallback="6")),
+            #"auto" probes for the largest window gracenote answers in full, starting from 3 hours
+            timespan=3 if timespan == "auto" else max(1, int(timespan)),
+            autoTimespan=timespan == "auto",
+            maxTimespan=min(24, max(1, int(getValue("fetch","maxTimespan", fallback="12")))),
+            renderWorkers=(os.cpu_count() or 1) if renderWorkers == "auto" else max(0, int(renderWorkers)),
+            artEnabled=ParseBool(getValue("art","enabled", fallback="false")),
+            artDir=getValue("art","dir", fallback=os.path.join(os.path.dirname(os.path.abspath(outputFile)), ".zap2itart")),
+            artMaxSize=int(float(getValue("art","maxMB", fallback="512")) * 1024 * 1024),
+            artFetchers=max(1, int(getValue("art","fetchers", fallback="4"))),
+            artUrl=getValue("art","url", fallback="").rstrip("/"))
+    def WantChannel(self, channelId):
+        if self.favoriteChannels and channelId not in self.favoriteChannels:
+            return False
+        return channelId not in self.excludeChannels
+
+def AcceptsGzip(acceptEncoding):
+    #"gzip;q=0" refuses gzip; "*" covers it unless gzip is listed on its own
+    qualities = {}
+    for token in (acceptEncoding or "").split(","):
+        coding, _, parameters = token.partition(";")
+        coding = coding.strip().lower()
+        if coding == "":
+            continue
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+class ServedFile():
+    #Immutable snapshot of one guide: raw bytes, validators and a gzipped copy made on the first gzip request
+    def __init__(self, data, mtime):
+        self.data = data
+        self.gzipData = None
+        self.lock = threading.Lock()
+        self.mtime = int(mtime)
+        digest = hashlib.sha1(data).hexdigest()
+        self.etag = '"' + digest + '"'
+        self.gzipEtag = '"' + digest + '-gz"'
+        self.lastModified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.index = None
+    def GzipData(self):
+        with self.lock:
+            if self.gzipData is None:
+                self.gzipData = gzip.compress(self.data, 6)
+            return self.gzipData
+
+def XMLTVTime(value, parsed):
+    #"202610162100 +0000" (seconds optional) to epoch seconds, memoised in parsed since the same values repeat across every channel
+    timestamp = parsed.get(value)
+    if timestamp is None:
+        digits, _, offset = value.partition(b" ")
+        timestamp = calendar.timegm((int(digits[0:4]), int(digits[4:6]), int(digits[6:8]), int(digits[8:10]), int(digits[10:12]), int(digits[12:14] or 0)))
+        offset = offset.strip()
+        if offset:
+            sign = -1 if offset[:1] == b"-" else 1
+            timestamp -= sign * (int(offset[-4:-2]) * 3600 + int(offset[-2:]) * 60)
+        parsed[value] = timestamp
+    return timestamp
+
+def ParseQueryTime(value):
+    #Epoch seconds, ISO 8601 or the XMLTV format used in the guide (a "+" in a query string arrives as a space)
+    value = value.strip()
+    match = re.fullmatch(r"(\d{12}|\d{14})(?:\s*([+-]?)(\d{4}))?", value)
+    if match:
+        return XMLTVTime((match.group(1) + " " + (match.group(2) or "+") + (match.group(3) or "0000")).encode("ascii"), {})
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        raise ValueError("Unrecognised time: " + value)
+
+class ChannelProgrammes():
+    #One channel's programmes sorted by start; maxStops is a running maximum so overlaps can be bisected too
+    __slots__ = ("starts", "stops", "maxStops", "begins", "ends")
+    def __init__(self, programmes):
+        programmes.sort()
+        self.starts = array.array("q", [programme[0] for programme in programmes])
+        self.stops = array.array("q", [programme[1] for programme in programmes])
+        self.maxStops = array.array("q", itertools.accumulate(self.stops, max))
+        self.begins = array.array("q", [programme[2] for programme in programmes])
+        self.ends = array.array("q", [programme[3] for programme in programmes])
+
+class GuideIndex():
+    #Byte offsets of every <channel> and <programme> in one guide snapshot, so queries slice the original fragments
+    channelPattern = re.compile(rb'\t<channel id="([^"]*)">\n')
+    programmePattern = re.compile(rb'\t<programme start="([^"]*)" stop="([^"]*)" channel="([^"]*)">\n')
+    displayNamePattern = re.compile(rb'<display-name>([^<]*)</display-name>')
+    #Query answers are kept up to this many bytes, least recently used first; each is charged twice its size to leave room for a gzipped copy
+    cacheBytes = 32 * 1024 * 1024
+    def __init__(self, data, mtime):
+        self.data = data
+        self.mtime = mtime
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cachedBytes = 0
+        tvStart = data.find(b"<tv")
+        self.header = data[:data.index(b">\n", tvStart) + 2] if tvStart >= 0 else b'<?xml version="1.0" ?>\n<tv>\n'
+        self.channels = {}
+        for match in self.channelPattern.finditer(data):
+            end = data.index(b"\t</channel>\n", match.end()) + len(b"\t</channel>\n")
+            channelId = self.Unescape(match.group(1))
+            name = self.displayNamePattern.search(data, match.end(), end)
+            if channelId not in self.channels:
+                self.channels[channelId] = (match.start(), end, self.Unescape(name.group(1)) if name else channelId)
+        programmes = {}
+        times = {}
+        for match in self.programmePattern.finditer(data):
+            end = data.index(b"\t</programme>\n", match.end()) + len(b"\t</programme>\n")
+            programmes.setdefault(self.Unescape(match.group(3)), []).append(
+                (XMLTVTime(match.group(1), times), XMLTVTime(match.group(2), times), match.start(), end))
+        self.programmes = {channelId: ChannelProgrammes(items) for channelId, items in programmes.items()}
+        self.order = list(self.channels) + [channelId for channelId in self.programmes if channelId not in self.channels]
+    def Unescape(self, value):
+        return xml.sax.saxutils.unescape(value.decode("utf8"), {"&quot;": '"'})
+    def Cached(self, key, render):
+        with self.lock:
+            served = self.cache.get(key)
+            if served is not None:
+                self.cache.move_to_end(key)
+                return served
+        served = render()
+        #Answers that would take most of the budget are not worth keeping
+        if 2 * len(served.data) > self.cacheBytes // 4:
+            return served
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = served
+                self.cachedBytes += 2 * len(served.data)
+            while self.cachedBytes > self.cacheBytes:
+                self.cachedBytes -= 2 * len(self.cache.popitem(last=False)[1].data)
+        return served
+    def Channels(self, channelIds):
+        if channelIds is None:
+            return self.order
+        return [channelId for channelId in channelIds if channelId in self.channels or channelId in self.programmes]
+    def Guide(self, channelIds=None, start=None, end=None):
+        #Every programme overlapping [start, end): bisect to the candidates, then drop any that ended before start
+        channelIds = self.Channels(channelIds)
+        selection = []
+        for channelId in channelIds:
+            programmes = self.programmes.get(channelId)
+            if programmes is None:
+                continue
+            lo = 0 if start is None else bisect.bisect_right(programmes.maxStops, start)
+            hi = len(programmes.starts) if end is None else bisect.bisect_left(programmes.starts, end)
+            selection.extend((programmes.begins[index], programmes.ends[index]) for index in range(lo, hi)
+                if start is None or programmes.stops[index] > start)
+        key = ("guide", tuple(channelIds), tuple(selection))
+        return self.Cached(key, lambda: self.RenderGuide(channelIds, selection))
+    def RenderGuide(self, channelIds, selection):
+        data = self.data
+        parts = [self.header]
+        for channelId in channelIds:
+            if channelId in self.channels:
+                begin, end = self.channels[channelId][:2]
+                parts.append(data[begin:end])
+        #Programmes keep the order they have in the full guide
+        for begin, end in sorted(selection):
+            parts.append(data[begin:end])
+        parts.append(b"</tv>\n")
+        return ServedFile(b"".join(parts), self.mtime)
+    def Airing(self, channelIds, at, upcoming):
+        #The programme on at `at` (or the first one starting after it) on every channel, as JSON
+        picks = []
+        for channelId in self.Channels(channelIds):
+            programmes = self.programmes.get(channelId)
+            if programmes is None:
+                continue
+            index = bisect.bisect_right(programmes.starts, at)
+            if not upcoming:
+                #Walk back over overlapping programmes until one is still on; maxStops says when none can be
+                index -= 1
+                while index >= 0 and programmes.maxStops[index] > at and programmes.stops[index] <= at:
+                    index -= 1
+                if index < 0 or programmes.stops[index] <= at:
+                    continue
+            elif index >= len(programmes.starts):
+                continue
+            picks.append((channelId, index))
+        key = ("next" if upcoming else "now",) + tuple((channelId, self.programmes[channelId].begins[index]) for channelId, index in picks)
+        return self.Cached(key, lambda: self.RenderAiring(picks))
+    def RenderAiring(self, picks):
+        result = []
+        for channelId, index in picks:
+            programmes = self.programmes[channelId]
+            element = ElementTree.fromstring(self.data[programmes.begins[index]:programmes.ends[index]])
+            icon = element.find("icon")
+            result.append({
+                "channel": channelId,
+                "channelName": self.channels[channelId][2] if channelId in self.channels else channelId,
+                "start": datetime.datetime.fromtimestamp(programmes.starts[index], datetime.timezone.utc).isoformat(),
+                "stop": datetime.datetime.fromtimestamp(programmes.stops[index], datetime.timezone.utc).isoformat(),
+                "title": element.findtext("title"),
+                "subTitle": element.findtext("sub-title"),
+                "desc": element.findtext("desc"),
+                "episode": element.findtext("episode-num[@system='common']"),
+                "icon": icon.get("src") if icon is not None else None
+            })
+        return ServedFile(json.dumps({"programmes": result}).encode("utf8"), self.mtime)
+
+class GuideStore():
+    #Guides served from memory; Load() swaps in a whole new snapshot, and its query index, so readers never see a partial one
+    def __init__(self):
+        self.files = {}
+    def Load(self, names, fileName):
+        with open(fileName, "rb") as file:
+            data = file.read()
+        served = ServedFile(data, os.path.getmtime(fileName))
+        #The full guide is what most clients fetch, so its gzipped copy is ready before it is served
+        served.GzipData()
+        served.index = GuideIndex(data, served.mtime)
+        for name in names:
+            self.files[name] = served
+        logging.info("Serving %s (%d bytes, %d channels)", ", ".join(names), len(data), len(served.index.order))
+    def Register(self, name):
+        self.files.setdefault(name, None)
+    def Has(self, name):
+        return name in self.files
+    def Get(self, name):
+        return self.files.get(name)
+
+class Metrics():
+    #Counters, gauges and summaries for every lineup, rendered in the Prometheus text format for /metrics
+    HELP = {
+        "zap2it_phase_seconds": ("summary", "Time spent in each build phase (summed over fetch threads)"),
+        "zap2it_grid_requests_total": ("counter", "Grid requests sent to gracenote by HTTP status"),
+        "zap2it_grid_request_seconds": ("summary", "Latency of grid requests sent to gracenote"),
+        "zap2it_grid_response_bytes_total": ("counter", "Decoded bytes of grid responses from gracenote"),
+        "zap2it_grid_windows_total": ("counter", "Grid windows used in builds by where they came from"),
+        "zap2it_grid_retries_total": ("counter", "Grid requests retried by reason"),
+        "zap2it_grid_windows_saved_total": ("counter", "Grid windows skipped because another zip code covers them"),
+        "zap2it_grid_timespan_hours": ("gauge", "Hours covered by each grid request in the last build"),
+        "zap2it_grid_windows_split_total": ("counter", "Grid windows refetched in smaller pieces because the response was cut short"),
+        "zap2it_guide_builds_total": ("counter", "Guide builds that completed"),
+        "zap2it_guide_build_failures_total": ("counter", "Guide builds that failed"),
+        "zap2it_guide_build_seconds": ("gauge", "Duration of the last successful build"),
+        "zap2it_guide_channels": ("gauge", "Channels in the last successful build"),
+        "zap2it_guide_programmes": ("gauge", "Programmes in the last successful build"),
+        "zap2it_guide_missing_windows": ("gauge", "Grid windows missing from the last successful build"),
+        "zap2it_guide_last_success_timestamp_seconds": ("gauge", "Unix time of the last successful build"),
+        "zap2it_guide_age_seconds": ("gauge", "Seconds since the last successful build"),
+    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+    def add(self, name, labels, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    def set(self, name, labels, value):
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+    def observe(self, name, labels, value):
+        with self.lock:
+            for suffix, amount in (("_sum", value), ("_count", 1)):
+                key = self.key(name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + amount
+    def FormatLabels(self, labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in labels) + "}"
+    def Render(self):
+        now = time.time()
+        with self.lock:
+            values = dict(self.values)
+        for (name, labels), value in list(values.items()):
+            if name == "zap2it_guide_last_success_timestamp_seconds":
+                values[("zap2it_guide_age_seconds", labels)] = now - value
+        lines = []
+        for family, (kind, helpText) in self.HELP.items():
+            samples = sorted((name, labels, value) for (name, labels), value in values.items()
+                if name == family or (kind == "summary" and name in (family + "_sum", family + "_count")))
+            if not samples:
+                continue
+            lines.append("# HELP %s %s" % (family, helpText))
+            lines.append("# TYPE %s %s" % (family, kind))
+            for name, labels, value in samples:
+                lines.append("%s%s %s" % (name, self.FormatLabels(labels), repr(float(value)) if isinstance(value, float) else value))
+        return ("\n".join(lines) + "\n").encode("utf8")
+
+class StateFile():
+    #Small JSON document kept between runs, e.g. the login; rewritten atomically on every change
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.data = None
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.fileName, "r", encoding="utf8") as file:
+                    self.data = json.load(file)
+            except (OSError, ValueError):
+                self.data = {}
+        return self.data
+    def get(self, key, default=None):
+        with self.lock:
+            return self.load().get(key, default)
+    def put(self, key, value):
+        with self.lock:
+            data = self.load()
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            tempName = "%s.%d.tmp" % (self.fileName, os.getpid())
+            try:
+                fd = os.open(tempName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf8") as file:
+                    json.dump(data, file, indent=1)
+                os.replace(tempName, self.fileName)
+            except OSError as e:
+                logging.warning("Could not save state to %s: %s", self.fileName, e)
+
+def RetryAfter(headers):
+    #Retry-After is either a number of seconds or an HTTP date
+    value = headers.get("Retry-After") if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def TokenExpiry(token, ttl):
+    #Tokens that are JWTs carry their own expiry; anything else is trusted for ttl seconds
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"]) - 300
+    except (IndexError, ValueError, KeyError, TypeError, AttributeError):
+        return time.time() + ttl
+
+class GracenoteSession():
+    #Shared by every lineup profile in the process: connections, pacing, the login and this cycle's grid windows
+    def __init__(self, settings):
+        self.rateLimiter = RateLimiter(settings.requestsPerSecond, settings.burst)
+        self.http = HttpClient(settings.timeout, settings.maxInFlight)
+        self.cache = None
+        if settings.cacheEnabled:
+            self.cache = GridCache(settings.cacheDir, settings.cacheNearTermHours, settings.cacheNearTermTTL, settings.cacheFarTermTTL)
+        #Windows fetched by a build that has not completed yet, so the next attempt can resume
+        self.checkpoint = None
+        if settings.checkpointHours > 0:
+            self.checkpoint = GridCache(settings.checkpointDir, 0, settings.checkpointHours, settings.checkpointHours)
+        self.refreshWindows = []
+        self.authLock = threading.Lock()
+        self.state = StateFile(settings.stateFile)
+        self.zapToken = None
+        self.headendid = None
+        self.authExpires = 0
+        self.shareWindows = False
+        self.sharedWindows = {}
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+    def GetShared(self, key):
+        with self.lock:
+            data = self.sharedWindows.get(key)
+        if data is None:
+            return None
+        return gzip.decompress(data)
+    def PutShared(self, key, data):
+        if not self.shareWindows:
+            return
+        with self.lock:
+            self.sharedWindows[key] = gzip.compress(data, 1)
+    def EndCycle(self):
+        with self.lock:
+            self.sharedWindows = {}
 
 class Zap2ItGuideScrape():
-    def __init__(self,configLocation="./zap2itconfig.ini",outputFile="xmlguide.xmltv"):
+    def __init__(self,configLocation="./zap2itconfig.ini",outputFile="xmlguide.xmltv",profile=None,session=None):
         self.confLocation = configLocation
         self.outputFile=outputFile
+        self.profile = profile
         if not os.path.exists(self.confLocation):
             logging.warn("Error: %s does not exist.", self.confLocation)
             logging.info("Copy config.ini.dist to config.ini and update the settings to match your zap2it account")
@@ -37,25 +1226,109 @@ class Zap2ItGuideScrape():
         if config == []:
             logging.error("Failed to read config, check permissions: %s", self.confLocation)
             exit(1)
-        # Use get_config_value for all config lookups
-        self.lang = self.get_config_value("prefs","lang", fallback="en")
+        # Resolve every config value once; nothing reads the config after this
+        self.settings = Settings.Load(self.get_config_value, self.outputFile)
+        settings = self.settings
+        self.lang = settings.lang if settings.lang is not None else "en"
+
+        self.maxInFlight = settings.maxInFlight
+        self.baseUrl = settings.baseUrl
+        self.session = session if session is not None else GracenoteSession(settings)
+
+        #Hours per grid request; in auto mode BuildGuide picks the remembered or probed size for the lineup
+        self.timespan = settings.timespan
+        self.windowTimespan = self.timespan
+        #The smallest timespan found cut short during the current build
+        self.truncatedTimespan = None
+        #Checkpointed windows of the current build, at whatever timespan they were fetched
+        self.checkpointKeys = set()
+        #Whether each zip offers the configured headend, for sharing windows with lineups in other zips
+        self.headendZips = {}
+
+        #Incremental mode keeps the last build's windows in memory and only refetches what changed
+        self.incremental = settings.incremental
+        self.refreshInterval = settings.refreshInterval
+        self.nearTermRefresh = settings.nearTermRefresh
+        self.windowData = {}
+        self.lastHistorical = 0
+
+        #The guide can be written in several formats at once, each next to the output file
+        self.outputFormats = []
+        for outputFormat in settings.outputFormats:
+            if outputFormat not in ("xmltv", "xmltv.gz", "jsonl", "sqlite"):
+                logging.warning("Ignoring unknown output format: %s", outputFormat)
+            elif outputFormat not in self.outputFormats:
+                self.outputFormats.append(outputFormat)
+        if not self.outputFormats:
+            self.outputFormats = ["xmltv"]
+        self.historyFormat = settings.historyFormat
+        if self.historyFormat not in ("xmltv", "xmltv.gz"):
+            logging.warning("Ignoring unknown history format: %s, keeping plain XMLTV copies", self.historyFormat)
+            self.historyFormat = "xmltv"
 
-        self.zapToken = ""
+        #Per build phase timings, also fed into the session's /metrics
+        self.lineupName = profile if profile is not None else "default"
+        self.phaseTimes = {}
+        self.phaseLock = threading.Lock()
+        #Fetch on the calling thread instead of the pool, so cProfile sees every phase
+        self.inlineFetch = False
+        #With more than one render worker, programme XML is rendered in other processes and written back in order
+        self.renderWorkers = settings.renderWorkers
+        self.renderPool = None
+        self.pendingWrites = collections.deque()
+        #In --web mode with [art] enabled, icons point at this server's /art/ and the build collects the originals to prefetch
+        self.artCache = None
+        self.artBase = None
+        self.artUrls = set()
+        #Windows that could not be fetched for the last guide written
+        self.missingWindows = []
+    def __getstate__(self):
+        #Render workers only get what BuildEventXmL needs
+        return {"lang": self.lang, "settings": self.settings, "artBase": self.artBase}
     def get_config_value(self, section, key, fallback=None):
+        #Lineup profiles can override any [prefs] or [lineup] key in their own [lineup_<name>] section
+        if self.profile is not None and section in ("prefs","lineup"):
+            value = self.get_config_value("lineup_" + self.profile, key)
+            if value is not None:
+                return value
         # Environment variable name: ZAP2IT_SECTION_KEY
         env_var = f"ZAP2IT_{section.upper()}_{key.upper()}"
-        print(f"Checking for environment variable: {env_var}")
         if env_var in os.environ:
-            print(f"Using environment variable {env_var} for {section}.{key}")
+            logging.debug("Using environment variable %s for %s.%s", env_var, section, key)
             return os.environ[env_var]
-        print(f"Using config.ini value for {section}.{key}")
+        logging.debug("Using config.ini value for %s.%s", section, key)
         return self.config.get(section, key, fallback=fallback)
+    @contextlib.contextmanager
+    def Phase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.phaseLock:
+                self.phaseTimes[phase] = self.phaseTimes.get(phase, 0) + elapsed
+            self.session.metrics.observe("zap2it_phase_seconds", {"lineup": self.lineupName, "phase": phase}, elapsed)
+    def LoadProfiles(self):
+        #Named lineups come from [prefs] lineups and any [lineup_<name>] sections
+        names = list(self.settings.lineups)
+        for section in self.config.sections():
+            if section.startswith("lineup_") and section[7:] not in names:
+                names.append(section[7:])
+        profiles = []
+        for name in names:
+            if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+                logging.warning("Skipping lineup with invalid name: %s", name)
+                continue
+            defaultFile = os.path.join(os.path.dirname(os.path.abspath(self.outputFile)), name + ".xmltv")
+            outputFile = self.get_config_value("lineup_" + name, "outputFile", fallback=defaultFile)
+            profiles.append(Zap2ItGuideScrape(self.confLocation, outputFile, name, self.session))
+        return profiles
 
     def BuildAuthRequest(self):
-        url = "https://tvlistings.gracenote.com/api/user/login"
+        url = self.baseUrl + "/api/user/login"
         parameters = {
-            "emailid": self.get_config_value("creds","username"),
-            "password": self.get_config_value("creds","password"),
+            "emailid": self.settings.username,
+            "password": self.settings.password,
             "isfacebookuser": "false",
             "usertype": 0,
             "objectid": ""
@@ -64,61 +1337,130 @@ class Zap2ItGuideScrape():
         data = data.encode('ascii')
         req = urllib.request.Request(url, data, headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'})
         return req
-    def Authenticate(self):
-        #Get token from login form
-        authRequest = self.BuildAuthRequest()
-        try:
-            authResponse = urllib.request.urlopen(authRequest, context=ssl_context).read()
-        except urllib.error.URLError as e:
-            logging.error("Error connecting to tvlistings.gracenote.com: %s", e.reason)
-            raise ValueError(f"Error connecting to tvlistings.gracenote.com: {e.reason}")
-        authFormVars = json.loads(authResponse)
-        self.zapTocken = authFormVars["token"]
-        self.headendid= authFormVars["properties"]["2004"]
+    def Authenticate(self, rejectedToken=None):
+        #Every profile shares one login, saved in the state file and reused until it expires or is rejected
+        session = self.session
+        account = [self.settings.username, self.baseUrl]
+        with session.authLock:
+            if rejectedToken is not None and rejectedToken == session.zapToken:
+                logging.info("Saved login was rejected, logging in again")
+                session.zapToken = None
+                session.state.put("auth", None)
+            if session.zapToken is None:
+                saved = session.state.get("auth")
+                if saved is not None and saved.get("account") == account and saved.get("expires", 0) > time.time():
+                    session.zapToken = saved["token"]
+                    session.headendid = saved["headendid"]
+                    session.authExpires = saved["expires"]
+                    logging.info("Using saved login until %s", datetime.datetime.fromtimestamp(session.authExpires))
+            if session.zapToken is not None and session.authExpires > time.time():
+                return False
+            #Get token from login form
+            authRequest = self.BuildAuthRequest()
+            try:
+                authResponse = session.http.open(authRequest)
+            except urllib.error.URLError as e:
+                logging.error("Error connecting to tvlistings.gracenote.com: %s", e.reason)
+                raise ValueError(f"Error connecting to tvlistings.gracenote.com: {e.reason}")
+            authFormVars = json.loads(authResponse)
+            session.zapToken = authFormVars["token"]
+            session.headendid = authFormVars["properties"]["2004"]
+            session.authExpires = TokenExpiry(session.zapToken, self.settings.tokenTTL)
+            session.state.put("auth", {
+                "account": account,
+                "token": session.zapToken,
+                "headendid": session.headendid,
+                "expires": session.authExpires
+            })
+            return True
     def BuildIDRequest(self,zipCode):
-        url = "https://tvlistings.gracenote.com/gapzap_webapi/api/Providers/getPostalCodeProviders/"
-        url += self.get_config_value("prefs","country", fallback="us") + "/"
+        url = self.baseUrl + "/gapzap_webapi/api/Providers/getPostalCodeProviders/"
+        url += (self.settings.country if self.settings.country is not None else "us") + "/"
         url += zipCode + "/gapzap/"
-        lang = self.get_config_value("prefs","lang", fallback="en-us")
+        lang = self.settings.lang if self.settings.lang is not None else "en-us"
         if lang != "":
             url += lang
         req = urllib.request.Request(url, data=None, headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'})
         return req
-    def FindID(self,zipCode):
+    def GetProviders(self,zipCode,refresh=False):
+        #Provider lists rarely change, so they are kept in the state file for a week
+        stateKey = "providers/%s/%s" % (self.settings.country, zipCode)
+        saved = self.session.state.get(stateKey)
+        if not refresh and saved is not None and time.time() - saved["time"] < 7 * 24 * 60 * 60:
+            return saved["providers"]
         idRequest = self.BuildIDRequest(zipCode)
+        logging.info("Loading provider ID data from: %s", idRequest.full_url)
+        providers = json.loads(self.session.http.open(idRequest))["Providers"]
+        self.session.state.put(stateKey, {"time": time.time(), "providers": providers})
+        return providers
+    def FindID(self,zipCode):
         try:
-            logging.info("Loading provider ID data from: %s", idRequest.full_url)
-            idResponse = urllib.request.urlopen(idRequest, context=ssl_context).read()
+            providers = self.GetProviders(zipCode,refresh=True)
         except urllib.error.URLError as e:
             logging.error("Error loading provider IDs: %s", e.reason)
             exit(1)
-        idVars = json.loads(idResponse)
-        logging.info(f'{"type":<15}|{"name":<40}|{"location":<15}|',end='')
-        logging.info(f'{"headendID":<15}|{"lineupId":<25}|{"device":<15}')
-        for provider in idVars["Providers"]:
-            logging.info(f'{provider["type"]:<15}|',end='')
-            logging.info(f'{provider["name"]:<40}|',end='')
-            logging.info(f'{provider["location"]:<15}|',end='')
-            logging.info(f'{provider["headendId"]:<15}|',end='')
-            logging.info(f'{provider["lineupId"]:<25}|',end='')
-            logging.info(f'{provider["device"]:<15}')
-
-    def BuildDataRequest(self,currentTime,zipCode):
+        logging.info(f'{"type":<15}|{"name":<40}|{"location":<15}|{"headendID":<15}|{"lineupId":<25}|{"device":<15}')
+        for provider in providers:
+            logging.info(f'{provider["type"]:<15}|{provider["name"]:<40}|{provider["location"]:<15}|'
+                f'{provider["headendId"]:<15}|{provider["lineupId"]:<25}|{provider["device"]:<15}')
+    def PlanZipCodes(self,zipCodes):
+        #Zips whose providers include the configured headend get the same grid, so only the first of them is fetched.
+        #Over the air listings depend on the zip itself and are never merged here.
+        headendId = self.settings.headendId
+        if not self.settings.coalesceZipCodes or headendId == "lineupId" or len(zipCodes) < 2:
+            return list(zipCodes)
+        lineups = {}
+        for zipCode in zipCodes:
+            lineup = zipCode
+            try:
+                for provider in self.GetProviders(zipCode):
+                    if provider["headendId"] == headendId:
+                        lineup = (provider["headendId"], provider["lineupId"])
+                        break
+                else:
+                    logging.info("Headend %s is not offered in %s, fetching it separately", headendId, zipCode)
+            except (urllib.error.URLError, ValueError, KeyError, TypeError) as e:
+                logging.warning("Could not load providers for %s, fetching it separately: %s", zipCode, e)
+            lineups.setdefault(lineup, []).append(zipCode)
+        for lineup, members in lineups.items():
+            if len(members) > 1:
+                logging.info("Zip codes %s share lineup %s, fetching %s only", members, lineup[1], members[0])
+        return [members[0] for members in lineups.values()]
+    def ChannelZips(self,zipCodes,firstWindows):
+        #After the first window, a zip is only fetched if it carries a wanted channel that no earlier zip has
+        if not self.settings.coalesceZipCodes:
+            return list(zipCodes)
+        seen = set()
+        channelZips = []
+        for zipCode, channels in zip(zipCodes,firstWindows):
+            if channels is None:
+                channelZips.append(zipCode)
+                continue
+            channelIds = set(channel.channelId for channel in channels)
+            if channelIds - seen:
+                channelZips.append(zipCode)
+                seen |= channelIds
+            else:
+                logging.info("Zip code %s adds no new channels, skipping its later windows", zipCode)
+        return channelZips
+
+    def GetLineup(self):
         #Defaults
-        lineupId = self.get_config_value("lineup","lineupId", fallback=self.headendid)
-        headendId = self.get_config_value("lineup","headendId", 'lineupId')
-        device = self.get_config_value("lineup","device", fallback='-')
+        lineupId = self.settings.lineupId if self.settings.lineupId is not None else self.session.headendid
+        return (lineupId,self.settings.headendId,self.settings.device)
+    def BuildDataRequest(self,currentTime,zipCode,timespan=None):
+        lineupId, headendId, device = self.GetLineup()
 
         parameters = {
             'Activity_ID': 1,
             'FromPage': "TV%20Guide",
             'AffiliateId': "orbebb",
-            'token': self.zapToken,
+            'token': self.session.zapToken,
             'aid': 'orbebb',
             'lineupId': lineupId,
-            'timespan': 3,
+            'timespan': timespan if timespan is not None else self.timespan,
             'headendId': headendId,
-            'country': self.get_config_value("prefs", "country"),
+            'country': self.settings.country,
             'device': device,
             'postalCode': zipCode,
             'isOverride': "true",
@@ -127,381 +1469,994 @@ class Zap2ItGuideScrape():
             'userId': '-'
         }
         data = urllib.parse.urlencode(parameters)
-        url = "https://tvlistings.gracenote.com/api/grid?" + data
+        url = self.baseUrl + "/api/grid?" + data
         req = urllib.request.Request(url, data=None, headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'})
         
         return req
-    def GetData(self,time,zipCode):
+    def GridWindowKey(self,windowStart,zipCode,timespan=None):
+        lineupId, headendId, device = self.GetLineup()
+        return WindowKey(lineupId,headendId,device,self.settings.country,zipCode,windowStart,timespan if timespan is not None else self.timespan)
+    def SharedWindowKey(self,windowStart,zipCode,timespan=None):
+        #As PlanZipCodes does within a lineup, a headend gets one grid in every zip that offers it, so lineups share it whatever their zip
+        lineupId, headendId, device = self.GetLineup()
+        if self.OffersHeadend(zipCode):
+            zipCode = None
+        return WindowKey(lineupId,headendId,device,self.settings.country,zipCode,windowStart,timespan if timespan is not None else self.timespan)
+    def OffersHeadend(self,zipCode):
+        headendId = self.settings.headendId
+        if not self.settings.coalesceZipCodes or headendId == "lineupId":
+            return False
+        if zipCode not in self.headendZips:
+            try:
+                self.headendZips[zipCode] = any(provider["headendId"] == headendId for provider in self.GetProviders(zipCode))
+            except (urllib.error.URLError, ValueError, KeyError, TypeError) as e:
+                logging.warning("Could not load providers for %s, sharing its windows by zip only: %s", zipCode, e)
+                self.headendZips[zipCode] = False
+        return self.headendZips[zipCode]
+    def Timespan(self,zipCode):
+        #The largest window that came back complete is remembered per lineup and probed again after a week
+        settings = self.settings
+        if not settings.autoTimespan:
+            return settings.timespan
+        stateKey = "timespans/%s/%s" % (settings.country, "/".join(str(value) for value in self.GetLineup()))
+        saved = self.session.state.get(stateKey)
+        if saved is not None and time.time() - saved["time"] < 7 * 24 * 60 * 60:
+            return saved["hours"]
+        timespan = self.ProbeTimespan(zipCode)
+        self.session.state.put(stateKey, {"time": time.time(), "hours": timespan})
+        return timespan
+    def ShrinkTimespan(self,timespan):
+        #Used when a window turns out to be cut short; the next build starts from half the size, or less if a half was cut short too
+        settings = self.settings
+        stateKey = "timespans/%s/%s" % (settings.country, "/".join(str(value) for value in self.GetLineup()))
+        hours = max(settings.timespan, timespan // 2)
+        with self.phaseLock:
+            saved = self.session.state.get(stateKey)
+            if saved is not None:
+                hours = min(hours, saved["hours"])
+            self.session.state.put(stateKey, {"time": time.time(), "hours": hours})
+    def ProbeTimespan(self,zipCode):
+        #Doubles the window from the base size for as long as gracenote returns the same channels listed to the end
+        settings = self.settings
+        baseTimespan = settings.timespan
+        windowStart = time.time()
+        windowStart -= windowStart % (60 * 60 * settings.maxTimespan)
+        try:
+            baseChannels = self.FetchGrid(windowStart,zipCode,None,baseTimespan)[1]
+        except Exception as e:
+            logging.warning("Could not probe grid timespans, using %d hours: %s", baseTimespan, e)
+            return baseTimespan
+        baseIds = set(channel.channelId for channel in baseChannels)
+        timespan = baseTimespan
+        while timespan * 2 <= settings.maxTimespan:
+            try:
+                channels = self.FetchGrid(windowStart,zipCode,None,timespan * 2)[1]
+            except Exception as e:
+                logging.info("Grid timespan of %d hours failed: %s", timespan * 2, e)
+                break
+            missingIds = baseIds - set(channel.channelId for channel in channels)
+            truncated = TruncatedChannels(channels,windowStart,timespan * 2,baseTimespan)
+            if missingIds or truncated:
+                logging.info("Grid timespan of %d hours is incomplete: %d channels missing, %d cut short",
+                    timespan * 2, len(missingIds), len(truncated))
+                break
+            timespan *= 2
+        logging.info("Using %d hour grid windows", timespan)
+        return timespan
+    def GetData(self,time,zipCode,refresh=False,allChannels=False,timespan=None):
         print("Building data for {time} :: {zipCode}")
-        request = self.BuildDataRequest(time,zipCode)
+        session = self.session
+        cache = session.cache
+        checkpoint = session.checkpoint
+        metrics = session.metrics
+        wantChannel = None if allChannels else self.settings.WantChannel
+        timespan = timespan if timespan is not None else self.timespan
+        windowKey = self.GridWindowKey(time,zipCode,timespan)
+        #Another profile may already have fetched this window during the current cycle
+        sharedKey = self.SharedWindowKey(time,zipCode,timespan) if session.shareWindows else windowKey
+        response = session.GetShared(sharedKey)
+        source = "shared"
+        refresh = refresh or self.WindowNeedsRefresh(time,timespan)
+        if response is None and cache is not None:
+            if refresh:
+                cache.count("refreshed")
+            else:
+                response = cache.get(windowKey,time)
+                source = "cache"
+        #An interrupted build left this window behind
+        if response is None and checkpoint is not None and not refresh:
+            response = checkpoint.get(windowKey,time)
+            source = "checkpoint"
+            if response is not None:
+                self.checkpointKeys.add(windowKey)
+        if response is not None:
+            try:
+                with self.Phase("parse"):
+                    channels = ParseGrid(response,wantChannel)
+                logging.info("%s Guide for time: %s :: %s",{"shared": "Shared", "cache": "Cached", "checkpoint": "Resumed"}[source],str(time),zipCode)
+                metrics.add("zap2it_grid_windows_total",{"lineup": self.lineupName, "source": source})
+                if source != "shared":
+                    session.PutShared(sharedKey,response)
+                return channels
+            except (ValueError, KeyError, TypeError):
+                logging.warning("Discarding unreadable %s copy of %s :: %s",source,str(time),zipCode)
+        baseTimespan = self.settings.timespan
+        #Once a window of this size came back cut short, the rest of the build goes straight to smaller pieces
+        truncatedTimespan = self.truncatedTimespan
+        if truncatedTimespan is not None and timespan >= truncatedTimespan and timespan > baseTimespan:
+            return self.GetPieces(time,zipCode,refresh,allChannels,timespan)
         logging.info("Load Guide for time: %s :: %s",str(time),zipCode)
-        response = urllib.request.urlopen(request, context=ssl_context).read()
-        return json.loads(response)
-    def AddChannelsToGuide(self, json):
-        global ADDED_CHANNELS
-        favoriteChannels = ""
-        try:
-            favoriteChannels = self.get_config_value("prefs","favoriteChannels", fallback="")
-        except:
-            pass
-        for channel in json["channels"]:
-            if favoriteChannels != "":
-                if channel["channelId"] not in favoriteChannels:
+        response, channels = self.FetchGrid(time,zipCode,wantChannel,timespan)
+        metrics.add("zap2it_grid_windows_total",{"lineup": self.lineupName, "source": "network"})
+        if self.settings.autoTimespan and timespan > baseTimespan:
+            truncated = TruncatedChannels(channels,time,timespan,baseTimespan)
+            if truncated:
+                #Not cached: the window is fetched again in halves, and later builds use smaller windows
+                logging.warning("Grid for %s :: %s stops short on %d channels, using %d hour windows from here on",
+                    str(time), zipCode, len(truncated), max(baseTimespan, timespan // 2))
+                metrics.add("zap2it_grid_windows_split_total",{"lineup": self.lineupName})
+                with self.phaseLock:
+                    if self.truncatedTimespan is None or timespan < self.truncatedTimespan:
+                        self.truncatedTimespan = timespan
+                self.ShrinkTimespan(timespan)
+                return self.GetPieces(time,zipCode,refresh,allChannels,timespan)
+        #The grid cache already lets an interrupted build resume, so the checkpoint only stands in for it
+        if cache is not None:
+            cache.put(windowKey,response)
+        elif checkpoint is not None:
+            checkpoint.put(windowKey,response)
+            self.checkpointKeys.add(windowKey)
+        session.PutShared(sharedKey,response)
+        return channels
+    def GetPieces(self,windowStart,zipCode,refresh,allChannels,timespan):
+        #One window as halves (never below the base size); each half is split again if it is too large as well
+        pieceTimespan = max(self.settings.timespan, timespan // 2)
+        pieces = []
+        pieceStart = windowStart
+        while pieceStart < windowStart + 60 * 60 * timespan:
+            pieces.append(self.GetData(pieceStart,zipCode,refresh,allChannels,pieceTimespan))
+            pieceStart += 60 * 60 * pieceTimespan
+        return MergeWindows(pieces)
+    def FetchGrid(self,windowStart,zipCode,wantChannel,timespan=None):
+        #Transient failures are retried with exponential backoff and jitter; 429/5xx also slow down every other request
+        session = self.session
+        settings = self.settings
+        labels = {"lineup": self.lineupName}
+        token = session.zapToken
+        reauthenticated = False
+        attempt = 0
+        while True:
+            session.rateLimiter.acquire()
+            delay = None
+            throttle = False
+            try:
+                response = self.OpenGrid(self.BuildDataRequest(windowStart,zipCode,timespan))
+                with self.Phase("parse"):
+                    channels = ParseGrid(response,wantChannel)
+                session.rateLimiter.recover()
+                return response, channels
+            except urllib.error.HTTPError as e:
+                if e.code in (401, 403) and not reauthenticated:
+                    #A saved login can be revoked before it expires; log in again and retry straight away
+                    self.Authenticate(rejectedToken=token)
+                    token = session.zapToken
+                    reauthenticated = True
                     continue
-            if channel["channelId"] in ADDED_CHANNELS:
-                logging.info("Duplicate Channel: %s" ,channel["channelId"])
-                continue
+                if e.code != 429 and e.code < 500:
+                    raise
+                error = e
+                reason = str(e.code)
+                delay = RetryAfter(e.headers)
+                throttle = True
+            except urllib.error.URLError as e:
+                error = e.reason
+                reason = "error"
+            except (ValueError, KeyError, TypeError, OSError, EOFError, zlib.error) as e:
+                error = "unreadable response (%s)" % e
+                reason = "unreadable"
+            if attempt >= settings.retries:
+                raise ValueError("Giving up on %s :: %s after %d attempts: %s" % (str(windowStart), zipCode, attempt + 1, error))
+            backoff = min(settings.retryMaxBackoff, settings.retryBackoff * 2 ** attempt) * random.uniform(0.5, 1)
+            if delay is not None:
+                backoff = max(backoff, delay)
+            attempt += 1
+            session.metrics.add("zap2it_grid_retries_total",dict(labels,reason=reason))
+            logging.warning("Retrying %s :: %s in %.1fs (attempt %d of %d): %s",
+                str(windowStart), zipCode, backoff, attempt + 1, settings.retries + 1, error)
+            if throttle:
+                session.rateLimiter.throttle(backoff)
             else:
-                self.rootEl.appendChild(self.BuildChannelXML(channel))
-                ADDED_CHANNELS.append(channel["channelId"])
-    def AddEventsToGuide(self,json):
-        dedup_count = 0
-        global ADDED_EVENTS
-        favoriteChannels = ""
+                time.sleep(backoff)
+    def OpenGrid(self,request):
+        metrics = self.session.metrics
+        labels = {"lineup": self.lineupName}
+        start = time.perf_counter()
         try:
-            favoriteChannels = self.get_config_value("prefs","favoriteChannels", fallback="")
-            if favoriteChannels == "":
-                print("No favorite channels set, all channels will be included.")
-                raise ValueError("No favorite channels set") #TODO: Pretty dirty
-        except:
-            pass
-        for channel in json["channels"]:
-            if favoriteChannels != "":
-                if channel["channelId"] not in favoriteChannels:
+            with self.Phase("fetch"):
+                response = self.session.http.open(request)
+        except urllib.error.HTTPError as e:
+            metrics.add("zap2it_grid_requests_total",dict(labels,status=str(e.code)))
+            raise
+        except urllib.error.URLError:
+            metrics.add("zap2it_grid_requests_total",dict(labels,status="error"))
+            raise
+        finally:
+            metrics.observe("zap2it_grid_request_seconds",labels,time.perf_counter() - start)
+        metrics.add("zap2it_grid_requests_total",dict(labels,status="200"))
+        metrics.add("zap2it_grid_response_bytes_total",labels,len(response))
+        return response
+    def WindowNeedsRefresh(self,windowStart,timespan=None):
+        timespan = timespan if timespan is not None else self.timespan
+        for refreshTime in self.session.refreshWindows:
+            if windowStart <= refreshTime < windowStart + (60 * 60 * timespan):
+                return True
+        return False
+    def AddChannelsToGuide(self, channels, zipCode=None):
+        with self.Phase("dedup"):
+            newChannels = []
+            for channel in channels:
+                if not self.dedup.AddChannel(channel.channelId,zipCode):
+                    logging.info("Duplicate Channel: %s" ,channel.channelId)
                     continue
-            for event in channel["events"]:
-                #Deduplicate json
-                eventHash = hash(channel.get("channelId") + event.get("startTime") + event.get("endTime"))
-                if eventHash not in ADDED_EVENTS:
-                    newChild = self.BuildEventXmL(event,channel["channelId"])
-                    self.rootEl.appendChild(newChild)
-                    ADDED_EVENTS.append(eventHash)                    
-    def BuildEventXmL(self,event,channelId):
+                else:
+                    newChannels.append(channel)
+        with self.Phase("render"):
+            xml = records = None
+            if self.xmlOutput:
+                xml = "".join([self.BuildChannelXML(channel) for channel in newChannels])
+            if self.recordOutput:
+                records = [self.ChannelRecord(channel) for channel in newChannels]
+            if self.artCache is not None:
+                self.artUrls.update(self.ChannelIcon(channel) for channel in newChannels)
+        self.QueueWrite("channels", xml, records)
+    def AddEventsToGuide(self,channels, zipCode=None):
+        #Deduplicate json
+        with self.Phase("dedup"):
+            newProgrammes = [programme for channel in channels for programme in channel.programmes
+                if self.dedup.AddEvent(programme.channelId,programme.startTime,programme.endTime,zipCode)]
+        with self.Phase("render"):
+            xml = records = None
+            if self.xmlOutput:
+                if self.renderPool is not None and newProgrammes:
+                    xml = self.renderPool.submit(RenderProgrammes, newProgrammes)
+                else:
+                    xml = "".join([self.BuildEventXmL(programme) for programme in newProgrammes])
+            if self.recordOutput:
+                records = [self.ProgrammeRecord(programme) for programme in newProgrammes]
+            if self.artCache is not None:
+                self.artUrls.update(self.ProgrammeIcon(programme) for programme in newProgrammes if programme.thumbnail is not None)
+        self.QueueWrite("programmes", xml, records)
+    def QueueWrite(self, kind, xml, records):
+        self.pendingWrites.append((kind, xml, records))
+        #Keep a couple of windows per worker rendering while the next ones are deduplicated
+        self.FlushWrites(self.renderWorkers * 2 if self.renderPool is not None else 0)
+    def FlushWrites(self, keep=0):
+        #Fragments go out in the order they were queued, so the guide matches a serial render
+        while self.pendingWrites:
+            kind, xml, records = self.pendingWrites[0]
+            if isinstance(xml, concurrent.futures.Future):
+                if len(self.pendingWrites) <= keep and not xml.done():
+                    break
+                with self.Phase("render"):
+                    xml = xml.result()
+            self.pendingWrites.popleft()
+            with self.Phase("write"):
+                for writer in self.writers:
+                    if kind == "channels":
+                        writer.AddChannels(xml, records)
+                    else:
+                        writer.AddProgrammes(xml, records)
+    def ChannelIcon(self,channel):
+        return "http://"+(channel.thumbnail.partition('?')[0] or "").lstrip('/')
+    def ProgrammeIcon(self,programme):
+        if programme.thumbnail is None:
+            return None
+        return "http://zap2it.tmsimg.com/assets/" + programme.thumbnail + ".jpg"
+    def IconUrl(self,url):
+        if self.artBase is None:
+            return url
+        return self.artBase + "/art/" + ArtId(url) + ".jpg"
+    def ChannelRecord(self,channel):
+        return {
+            "id": channel.channelId,
+            "number": channel.channelNo,
+            "callSign": channel.callSign,
+            "name": channel.affiliateName.title(),
+            "icon": self.ChannelIcon(channel)
+        }
+    def ProgrammeRecord(self,programme):
+        return {
+            "channel": programme.channelId,
+            "start": programme.startTime,
+            "stop": programme.endTime,
+            "title": programme.title,
+            "subTitle": programme.episodeTitle,
+            "description": programme.shortDesc,
+            "duration": programme.duration,
+            "season": programme.season,
+            "episode": programme.episode,
+            "categories": list(programme.categories),
+            "flags": list(programme.flags),
+            "tags": list(programme.tags),
+            "rating": programme.rating,
+            "seriesId": programme.seriesId,
+            "programId": programme.programId,
+            "icon": self.ProgrammeIcon(programme)
+        }
+    def BuildEventXmL(self,programme):
         #preConfig
         season = "0"
         episode = "0"
 
-        programEl = self.guideXML.createElement("programme")
-        programEl.setAttribute("start",self.BuildXMLDate(event["startTime"]))
-        programEl.setAttribute("stop",self.BuildXMLDate(event["endTime"]))
-        programEl.setAttribute("channel",channelId)
-
-        titleEl = self.guideXML.createElement("title")
-        titleEl.setAttribute("lang",self.lang) #TODO: define
-        titleTextEl = self.guideXML.createTextNode(event["program"]["title"])
-        titleEl.appendChild(titleTextEl)
-        programEl.appendChild(titleEl)
-
-        if event["program"]["episodeTitle"] is not None:
-            subTitleEl = self.CreateElementWithData("sub-title",event["program"]["episodeTitle"])
-            subTitleEl.setAttribute("lang",self.lang)
-            programEl.appendChild(subTitleEl)
-
-        if event["program"]["shortDesc"] is None:
-            event["program"]["shortDesc"] = "Unavailable"
-        descriptionEl = self.CreateElementWithData("desc",event["program"]["shortDesc"])
-        descriptionEl.setAttribute("lang",self.lang)
-        programEl.appendChild(descriptionEl)
-
-        lengthEl = self.CreateElementWithData("length",event["duration"])
-        lengthEl.setAttribute("units","minutes")
-        programEl.appendChild(lengthEl)
-
-        if event["thumbnail"] is not None:
-            thumbnailEl = self.CreateElementWithData("thumbnail","http://zap2it.tmsimg.com/assets/" + event["thumbnail"] + ".jpg")
-            programEl.appendChild(thumbnailEl)
-            iconEl = self.guideXML.createElement("icon")
-            iconEl.setAttribute("src","http://zap2it.tmsimg.com/assets/" + event["thumbnail"] + ".jpg")
-            programEl.appendChild(iconEl)
-
-
-        urlEl = self.CreateElementWithData("url","https://tvlistings.gracenote.com//overview.html?programSeriesId=" + event["seriesId"] + "&amp;tmsId=" + event["program"]["id"])
-        programEl.appendChild(urlEl)
+        programEl = [XMLElement("programme",{
+            "start": self.BuildXMLDate(programme.startTime),
+            "stop": self.BuildXMLDate(programme.endTime),
+            "channel": programme.channelId}, depth=1)[:-3] + ">\n"]
+
+        programEl.append(XMLElement("title",{"lang": self.lang},programme.title))
+
+        if programme.episodeTitle is not None:
+            programEl.append(XMLElement("sub-title",{"lang": self.lang},programme.episodeTitle))
+
+        shortDesc = programme.shortDesc
+        if shortDesc is None:
+            shortDesc = "Unavailable"
+        programEl.append(XMLElement("desc",{"lang": self.lang},shortDesc))
+
+        programEl.append(XMLElement("length",{"units": "minutes"},programme.duration))
+
+        if programme.thumbnail is not None:
+            icon = self.IconUrl(self.ProgrammeIcon(programme))
+            programEl.append(XMLElement("thumbnail",None,icon))
+            programEl.append(XMLElement("icon",{"src": icon}))
+
+        programEl.append(XMLElement("url",None,"https://tvlistings.gracenote.com//overview.html?programSeriesId=" + programme.seriesId + "&tmsId=" + programme.programId))
         #Build Season Data
-        try:
-            if event["program"]["season"] is not None:
-                season = str(event["program"]["season"])
-            if event["program"]["episode"] is not None:
-                episode = str(event["program"]["episode"])
-        except KeyError:
-            logging.info("No Season for: %s", event["program"]["title"])
-
-        for category in event["filter"]:
-            categoryEl = self.CreateElementWithData("category",category.replace('filter-',''))
-            categoryEl.setAttribute("lang",self.lang)
-            programEl.appendChild(categoryEl)
+        if programme.season is not None:
+            season = programme.season
+        if programme.episode is not None:
+            episode = programme.episode
+
+        for category in programme.categories:
+            programEl.append(XMLElement("category",{"lang": self.lang},category))
 
         if(int(episode) != 0):
-            categoryEl = self.CreateElementWithData("category","Series")
-            programEl.appendChild(categoryEl)
+            programEl.append(XMLElement("category",None,"Series"))
             #episodeNum =  "S" + str(event["seriesId"]).zfill(2) + "E" + str(episode.zfill(2))
             episodeNum =  "S" + str(season).zfill(2) + "E" + str(episode.zfill(2))
-            episodeNumEl = self.CreateElementWithData("episode-num",episodeNum)
-            episodeNumEl.setAttribute("system","common")
-            programEl.appendChild(episodeNumEl)
+            programEl.append(XMLElement("episode-num",{"system": "common"},episodeNum))
             seasonStr = ""
             if(int(season) != 0):
                 seasonStr = str(int(season)-1)
             episodeNum = seasonStr + "." +str(int(episode)-1)
-            episodeNumEl = self.CreateElementWithData("episode-num",episodeNum)
-            episodeNumEl.setAttribute("system", "xmltv_ns")
-            programEl.appendChild(episodeNumEl)
+            programEl.append(XMLElement("episode-num",{"system": "xmltv_ns"},episodeNum))
 
-        if event["program"]["id"[-4:]] == "0000":
-            episodeNumEl = self.CreateElementWithData("episode-num",event["seriesId"] + '.' + event["program"]["id"][-4:])
-            episodeNumEl.setAttribute("system","dd_progid")
+        if programme.programId == "0000":
+            programEl.append(XMLElement("episode-num",{"system": "dd_progid"},programme.seriesId + '.' + programme.programId[-4:]))
         else:
-            episodeNumEl = self.CreateElementWithData("episode-num",event["seriesId"].replace('SH','EP') + '.' + event["program"]["id"][-4:])
-            episodeNumEl.setAttribute("system","dd_progid")
-        programEl.appendChild(episodeNumEl)
+            programEl.append(XMLElement("episode-num",{"system": "dd_progid"},programme.seriesId.replace('SH','EP') + '.' + programme.programId[-4:]))
 
         #Handle Flags
-        for flag in event["flag"]:
+        for flag in programme.flags:
             if flag == "New":
-                programEl.appendChild(self.guideXML.createElement("New"))
+                programEl.append(XMLElement("New"))
             if flag == "Finale":
-                programEl.appendChild(self.guideXML.createElement("Finale"))
+                programEl.append(XMLElement("Finale"))
             if flag == "Premiere":
-                programEl.appendChild(self.guideXML.createElement("Premiere"))
-        if "New" not in event["flag"]:
-            programEl.appendChild(self.guideXML.createElement("previously-shown"))
-        for tag in event["tags"]:
+                programEl.append(XMLElement("Premiere"))
+        if "New" not in programme.flags:
+            programEl.append(XMLElement("previously-shown"))
+        for tag in programme.tags:
             if tag == "CC":
-                subtitlesEl = self.guideXML.createElement("subtitle")
-                subtitlesEl.setAttribute("type","teletext")
-                programEl.appendChild(subtitlesEl)
-        if event["rating"] is not None:
-            ratingEl = self.guideXML.createElement("rating")
-            valueEl = self.CreateElementWithData("value",event["rating"])
-            ratingEl.appendChild(valueEl)
-            programEl.appendChild(ratingEl)
-        return programEl
+                programEl.append(XMLElement("subtitle",{"type": "teletext"}))
+        if programme.rating is not None:
+            programEl.append("\t\t<rating>\n")
+            programEl.append(XMLElement("value",None,programme.rating,depth=3))
+            programEl.append("\t\t</rating>\n")
+        programEl.append("\t</programme>\n")
+        return "".join(programEl)
     def BuildXMLDate(self,inTime):
         output = inTime.replace('-','').replace('T','').replace(':','')
         output = output.replace('Z',' +0000')
         return output
     def BuildChannelXML(self,channel):
-        channelEl = self.guideXML.createElement('channel')
-        channelEl.setAttribute('id',channel["channelId"])
-        dispName1 = self.CreateElementWithData("display-name",channel["channelNo"] + " " + channel["callSign"])
-        dispName2 = self.CreateElementWithData("display-name",channel["channelNo"])
-        dispName3 = self.CreateElementWithData("display-name",channel["callSign"])
-        dispName4 = self.CreateElementWithData("display-name",channel["affiliateName"].title())
-        iconEl = self.guideXML.createElement("icon")
-        iconEl.setAttribute("src","http://"+(channel["thumbnail"].partition('?')[0] or "").lstrip('/'))
-        channelEl.appendChild(dispName1)
-        channelEl.appendChild(dispName2)
-        channelEl.appendChild(dispName3)
-        channelEl.appendChild(dispName4)
-        channelEl.appendChild(iconEl)
-        return channelEl
-
-    def CreateElementWithData(self,name,data):
-        el = self.guideXML.createElement(name)
-        elText = self.guideXML.createTextNode(data)
-        el.appendChild(elText)
-        return el
+        channelEl = [XMLElement("channel",{"id": channel.channelId},depth=1)[:-3] + ">\n"]
+        channelEl.append(XMLElement("display-name",None,channel.channelNo + " " + channel.callSign))
+        channelEl.append(XMLElement("display-name",None,channel.channelNo))
+        channelEl.append(XMLElement("display-name",None,channel.callSign))
+        channelEl.append(XMLElement("display-name",None,channel.affiliateName.title()))
+        channelEl.append(XMLElement("icon",{"src": self.IconUrl(self.ChannelIcon(channel))}))
+        channelEl.append("\t</channel>\n")
+        return "".join(channelEl)
+
     def GetGuideTimes(self):
         currentTimestamp = time.time()
         currentTimestamp -= 60 * 60 * 24
-        halfHourOffset = currentTimestamp % (60 * 30)
-        currentTimestamp = currentTimestamp - halfHourOffset
-        days = 14
-        try:
-            days = int(self.get_config_value("prefs","guideDays", fallback="14"))
-        except:
-            logging.info("guideDays not in config. using default: 14")
+        #Align to the window size so consecutive runs request the same (cacheable) windows.
+        #The end stays where base sized windows put it, so larger windows never shorten the guide.
+        endTimeStamp = currentTimestamp - currentTimestamp % (60 * 60 * self.settings.timespan)
+        windowOffset = currentTimestamp % (60 * 60 * self.timespan)
+        currentTimestamp = currentTimestamp - windowOffset
+        days = self.settings.guideDays
         logging.info("Loading guide data for %s days", days)
-        endTimeStamp = currentTimestamp + (60 * 60 * 24 * days)
+        endTimeStamp += 60 * 60 * 24 * days
         return (currentTimestamp,endTimeStamp)
-    def BuildRootEl(self):
-        self.rootEl = self.guideXML.createElement('tv')
-        self.rootEl.setAttribute("source-info-url","http://tvlistings.gracenote.com/")
-        self.rootEl.setAttribute("source-info-name","zap2it")
-        self.rootEl.setAttribute("generator-info-name","zap2it-GuideScraping)")
-        self.rootEl.setAttribute("generator-info-url","daniel@widrick.net")
+    def BuildRootAttributes(self):
+        return {
+            "source-info-url": "http://tvlistings.gracenote.com/",
+            "source-info-name": "zap2it",
+            "generator-info-name": "zap2it-GuideScraping)",
+            "generator-info-url": "daniel@widrick.net"
+        }
     def BuildGuide(self):
-        self.Authenticate()
-        time.sleep(5)
-        self.guideXML = xml.dom.minidom.Document()
-        self.BuildRootEl()
+        if self.profile is not None:
+            logging.info("Building lineup: %s", self.profile)
+        session = self.session
+        session.http.ResetStats()
+        if session.cache is not None:
+            session.cache.ResetStats()
+        buildStart = time.perf_counter()
+        self.phaseTimes = {}
+        with self.Phase("authenticate"):
+            self.Authenticate()
+
+        zipCodes = loadZipCodes(self.settings)
+        #The first window of every distinct lineup shows which zips the later windows are needed for
+        fetchZips = self.PlanZipCodes(zipCodes)
+        self.timespan = self.Timespan(fetchZips[0])
+        self.truncatedTimespan = None
+        self.checkpointKeys = set()
+        labels = {"lineup": self.lineupName}
+        session.metrics.set("zap2it_grid_timespan_hours", labels, self.timespan)
 
-        addChannels = True;
         times = self.GetGuideTimes()
         loopTime = times[0]
-        zipCodes = loadZipCodes()
+        windowTimes = []
         while(loopTime < times[1]):
-            for zipCode in zipCodes:
-                zipCode = str(zipCode)
-                zipCode = zipCode.strip()
-                zip_json = self.GetData(loopTime,zipCode)
-                time.sleep(5)
-                if addChannels:
-                    self.AddChannelsToGuide(zip_json)   
-                self.AddEventsToGuide(zip_json)
-            addChannels = False
-            loopTime += (60 * 60 * 3)
-        self.guideXML.appendChild(self.rootEl)
-        self.WriteGuide()
-        self.CopyHistorical()
-        self.CleanHistorical()
+            windowTimes.append(loopTime)
+            loopTime += (60 * 60 * self.timespan)
+        firstWindows = [(times[0],zipCode) for zipCode in fetchZips]
+
+        #Reuse windows from the previous build, except the ones about to air where late changes happen.
+        #Windows of a different size do not line up, so a change of timespan starts over.
+        previous = self.windowData if self.windowTimespan == self.timespan else {}
+        now = time.time()
+        def NearTerm(window):
+            return window[0] < now + self.nearTermRefresh and window[0] + (60 * 60 * self.timespan) > now
+        missing = []
+        def FetchWindow(window):
+            refetch = window in previous and NearTerm(window)
+            if window in previous and not refetch:
+                session.metrics.add("zap2it_grid_windows_total",dict(labels,source="reused"))
+                return previous[window]
+            #Whatever went wrong, the rest of the guide is still worth building
+            try:
+                return self.GetData(window[0],window[1],refresh=refetch)
+            except Exception as e:
+                logging.warning("Window %s :: %s is missing: %s", str(window[0]), window[1], e)
+                missing.append((window, str(e)))
+                return None
+
+        #Fetch concurrently but merge in (time, zip) order so the output matches a serial build
+        self.windowData = {}
+        self.windowTimespan = self.timespan
+        self.OpenWriters()
+        self.dedup = DedupIndex()
+        self.artUrls = set()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxInFlight)
+        try:
+            if self.renderWorkers > 1 and self.xmlOutput:
+                #Forking here would copy the fetch threads' locks mid-use, so workers start from a clean process
+                startMethod = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self.renderPool = concurrent.futures.ProcessPoolExecutor(max_workers=self.renderWorkers,
+                    mp_context=multiprocessing.get_context(startMethod), initializer=InitRenderWorker, initargs=(self,))
+            #A slow window at the front holds back only a few finished ones, so memory stays near one window per thread
+            fetch = lambda fn, items: BoundedMap(pool, fn, items, 2 * self.maxInFlight)
+            if self.inlineFetch:
+                fetch = map
+            firstResults = list(fetch(FetchWindow, firstWindows))
+            channelZips = self.ChannelZips(fetchZips, firstResults)
+            laterWindows = [(windowTime,zipCode) for windowTime in windowTimes[1:] for zipCode in channelZips]
+            windows = firstWindows + laterWindows
+            saved = len(windowTimes) * len(zipCodes) - len(windows)
+            if saved:
+                logging.info("Zip code coalescing: fetching %d of %d windows, %d requests saved", len(windows), len(windowTimes) * len(zipCodes), saved)
+                session.metrics.add("zap2it_grid_windows_saved_total", labels, saved)
+            if self.incremental and previous:
+                refetch = [window for window in windows if window in previous and NearTerm(window)]
+                logging.info("Incremental refresh: reusing %d windows, refetching %d near-term, fetching %d new, dropping %d aged out",
+                    len([window for window in windows if window in previous]) - len(refetch), len(refetch),
+                    len([window for window in windows if window not in previous]),
+                    len([window for window in previous if window not in windows]))
+            results = itertools.chain(firstResults, fetch(FetchWindow, laterWindows))
+            channelsAdded = set()
+            for (loopTime,zipCode), zip_json in zip(windows,results):
+                if zip_json is None:
+                    continue
+                #Channels come from the first window each zip returned, normally the first of the guide
+                if zipCode not in channelsAdded:
+                    channelsAdded.add(zipCode)
+                    self.AddChannelsToGuide(zip_json,zipCode)
+                self.AddEventsToGuide(zip_json,zipCode)
+                if self.incremental:
+                    self.windowData[(loopTime,zipCode)] = zip_json
+            self.FlushWrites()
+            if len(missing) * 100 > len(windows) * self.settings.maxMissing or len(missing) == len(windows):
+                raise ValueError("%d of %d windows could not be fetched; keeping the previous guide" % (len(missing), len(windows)))
+        except:
+            for writer in self.writers:
+                writer.abort()
+            self.writers = []
+            self.windowData = previous
+            raise
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.pendingWrites.clear()
+            if self.renderPool is not None:
+                self.renderPool.shutdown(wait=True, cancel_futures=True)
+                self.renderPool = None
+        with self.Phase("write"):
+            self.WriteGuide()
+        with self.Phase("historical"):
+            self.CopyHistorical()
+        with self.Phase("cleanup"):
+            self.CleanHistorical()
+        self.ReportMissing(sorted(missing))
+        if session.checkpoint is not None:
+            #A complete guide needs no resuming; a partial one keeps its windows for the retry
+            if not missing:
+                #Split windows were checkpointed as their pieces, so the keys written are removed as well
+                for key in self.checkpointKeys.union(self.GridWindowKey(window[0],window[1]) for window in windows):
+                    session.checkpoint.remove(key)
+            session.checkpoint.prune()
+        buildTime = time.perf_counter() - buildStart
+        self.dedup.LogStats()
+        session.http.LogStats()
+        if session.cache is not None:
+            session.cache.LogStats()
+            session.cache.prune()
+        logging.info("Build took %.2fs: %s", buildTime,
+            ", ".join("%s %.2fs" % (phase, seconds) for phase, seconds in self.phaseTimes.items()))
+        metrics = session.metrics
+        metrics.add("zap2it_guide_builds_total", labels)
+        metrics.set("zap2it_guide_build_seconds", labels, buildTime)
+        metrics.set("zap2it_guide_channels", labels, len(self.dedup.channels))
+        metrics.set("zap2it_guide_programmes", labels, len(self.dedup.events))
+        metrics.set("zap2it_guide_missing_windows", labels, len(missing))
+        metrics.set("zap2it_guide_last_success_timestamp_seconds", labels, time.time())
+    def ReportMissing(self, missing):
+        #The list of missing windows is kept next to the guide until a complete build replaces it
+        self.missingWindows = missing
+        reportFile = self.outputFile + ".missing.json"
+        if not missing:
+            if os.path.exists(reportFile):
+                os.remove(reportFile)
+            return
+        logging.warning("Guide is partial, %d windows are missing:", len(missing))
+        report = []
+        for (windowStart, zipCode), error in missing:
+            start = datetime.datetime.fromtimestamp(windowStart).isoformat()
+            logging.warning("  %s :: %s: %s", start, zipCode, error)
+            report.append({"start": start, "time": windowStart, "hours": self.timespan, "zipCode": zipCode, "error": error})
+        with open(reportFile, "w") as file:
+            json.dump(report, file, indent=1)
+    def OutputFile(self, outputFormat):
+        #xmlguide.xmltv also gives xmlguide.xmltv.gz, xmlguide.jsonl and xmlguide.sqlite
+        if outputFormat == "xmltv":
+            return self.outputFile
+        return self.outputFile.removesuffix(".xmltv") + "." + outputFormat
+    def OpenWriters(self):
+        self.writers = []
+        try:
+            for outputFormat in self.outputFormats:
+                fileName = self.OutputFile(outputFormat)
+                if outputFormat in ("xmltv", "xmltv.gz"):
+                    self.writers.append(XMLTVWriter(fileName, self.BuildRootAttributes(), compress=outputFormat == "xmltv.gz"))
+                elif outputFormat == "jsonl":
+                    self.writers.append(JSONLinesWriter(fileName))
+                elif outputFormat == "sqlite":
+                    self.writers.append(SQLiteWriter(fileName))
+        except:
+            for writer in self.writers:
+                writer.abort()
+            raise
+        self.xmlOutput = "xmltv" in self.outputFormats or "xmltv.gz" in self.outputFormats
+        self.recordOutput = "jsonl" in self.outputFormats or "sqlite" in self.outputFormats
     def WriteGuide(self):
-        with open(self.outputFile,"wb") as file:
-            file.write(self.guideXML.toprettyxml().encode("utf8"))
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
     def CopyHistorical(self):
+        #Incremental refreshes run often; keep at most one historical copy a day
+        if self.incremental and time.time() - self.lastHistorical < 60 * 60 * 24:
+            return
+        self.lastHistorical = time.time()
         dateTimeObj = datetime.datetime.now()
-        timestampStr = "." + dateTimeObj.strftime("%Y%m%d%H%M%S") + '.xmltv'
-        histGuideFile = timestampStr.join(optGuideFile.rsplit('.xmltv',1))
-        with open(histGuideFile,"wb") as file:
-            file.write(self.guideXML.toprettyxml().encode("utf8"))
+        compress = self.historyFormat == "xmltv.gz"
+        #Copy from the XMLTV output that needs no conversion, if there is one
+        sources = [outputFormat for outputFormat in (("xmltv.gz", "xmltv") if compress else ("xmltv", "xmltv.gz")) if outputFormat in self.outputFormats]
+        if not sources:
+            logging.warning("No historical copy kept: output formats %s include no XMLTV guide", ", ".join(self.outputFormats))
+            return
+        source = self.OutputFile(sources[0])
+        histGuideFile = self.outputFile.removesuffix(".xmltv") + "." + dateTimeObj.strftime("%Y%m%d%H%M%S") + (".xmltv.gz" if compress else ".xmltv")
+        if compress and not source.endswith(".gz"):
+            #Archives are written once and rarely read, so they are compressed harder than the guide
+            with open(source, "rb") as inFile, gzip.GzipFile(histGuideFile + ".tmp", "wb", compresslevel=9, mtime=0) as outFile:
+                shutil.copyfileobj(inFile, outFile, 1024 * 1024)
+            os.replace(histGuideFile + ".tmp", histGuideFile)
+            return
+        if not compress and source.endswith(".gz"):
+            with gzip.open(source, "rb") as inFile, open(histGuideFile + ".tmp", "wb") as outFile:
+                shutil.copyfileobj(inFile, outFile, 1024 * 1024)
+            os.replace(histGuideFile + ".tmp", histGuideFile)
+            return
+        #The next build replaces the guide with a new file, so a hardlink keeps this copy intact
+        try:
+            os.link(source,histGuideFile)
+        except OSError:
+            shutil.copyfile(source,histGuideFile)
     def CleanHistorical(self):
+        #Only this guide's own archives (<name>.<YYYYmmddHHMMSS>.xmltv[.gz]); their age is in the name
         outputFilePath = os.path.abspath(self.outputFile)
         outputDir = os.path.dirname(outputFilePath)
+        histGuideDays = self.settings.historicalGuideDays
+        pattern = re.compile(re.escape(os.path.basename(outputFilePath).removesuffix(".xmltv")) + r"\.(\d{14})\.xmltv(\.gz)?")
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=histGuideDays)).strftime("%Y%m%d%H%M%S")
         for item in os.listdir(outputDir):
-            fileName = os.path.join(outputDir,item)
-            if os.path.isfile(fileName) & item.endswith('.xmltv'):
-                histGuideDays = self.get_config_value("prefs","historicalGuideDays", fallback="30")
-                if (time.time() - os.stat(fileName).st_mtime) >= int(histGuideDays) * 86400:
-                    os.remove(fileName)
+            match = pattern.fullmatch(item)
+            if match and match.group(1) <= cutoff:
+                try:
+                    os.remove(os.path.join(outputDir,item))
+                except OSError as e:
+                    logging.warning("Could not remove old guide %s: %s", item, e)
 
     def showAvailableChannels(self):
-        allJSON = []
+        channelList = {}
         self.Authenticate()
-        for zipCode in loadZipCodes():
-            zipCode = str(zipCode)
-            zipCode = zipCode.strip()
+        windowStart = time.time()
+        windowStart -= windowStart % (60 * 60 * self.timespan)
+        for zipCode in self.PlanZipCodes(loadZipCodes(self.settings)):
             logging.info("Loading available channels for: %s", zipCode)
-            my_json = guide.GetData(time.time(), zipCode)
-            allJSON.append(my_json)
-        channelList = {}
-        for zip in allJSON:
-            for channel in zip["channels"]:
-                chanid = channel.get("channelId")
-                chanid = int(chanid)
-                channelList[chanid] = channel.get("callSign")  + "::" + channel.get("channelNo")
-        logging.info(f'{"CHAN ID":<15}|{"name":<40}|',end='')
+            for channel in self.GetData(windowStart, zipCode, allChannels=True):
+                channelList[int(channel.channelId)] = channel.callSign + "::" + channel.channelNo
+        self.session.http.LogStats()
+        logging.info(f'{"CHAN ID":<15}|{"name":<40}|')
         for channel in channelList:
-            logging.info(f'{channel:<15}|',end='')
-            logging.info(f'{channelList[channel]:<40}')
+            logging.info(f'{channel:<15}|{channelList[channel]:<40}|')
 
-def loadZipCodes():
-    zipCodes = guide.get_config_value("prefs","zipCode", fallback="")
-    if zipCodes == "":
+def loadZipCodes(settings):
+    zipCodes = settings.zipCodes
+    if not zipCodes:
         print("No Zip Codes configured in config.ini")
         print("Please set the zipCode in the config.ini file under [prefs] section")
         exit(1)
-    try:
-        zipCodes = json.loads(zipCodes)
-        if not isinstance(zipCodes,list):
-            zipCodes = [zipCodes]
-    except json.JSONDecodeError:
-        zipCodes = [zipCodes] #Support the old format
-    logging.info("Loaded Zip Codes: %s",zipCodes)
+    logging.info("Loaded Zip Codes: %s",list(zipCodes))
     return zipCodes
 
+def ParseRefreshTime(value):
+    #argparse type for --refresh-window: epoch seconds or an ISO date
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected epoch seconds or an ISO date, got %r" % value)
+
 
 #Run the Scraper
-optConfigFile = './zap2itconfig.ini'
-optGuideFile = 'xmlguide.xmltv'
-optLanguage = 'en'
-
-
-parser = argparse.ArgumentParser("Parse Zap2it Guide into XMLTV")
-parser.add_argument("-c","--configfile","-i","--ifile", help='Path to config file')
-parser.add_argument("-o","--outputfile","--ofile", help='Path to output file')
-parser.add_argument("-l","--language", help='Language')
-parser.add_argument("-f","--findid", action="store_true", help='Find Headendid / lineupid')
-parser.add_argument("-C","--channels", action="store_true", help='List available channels')
-parser.add_argument("-w","--web", action="store_true", help="Start a webserver at http://localhost:9000 to serve /xmlguide.xmltv")
-
-args = parser.parse_args()
-logging.info("%s", args)
-if args.configfile is not None:
-    optConfigFile = args.configfile
-if args.outputfile is not None:
-    optGuideFile = args.outputfile
-if args.language is not None:
-    optLanguage = args.language
-
-guide = Zap2ItGuideScrape(optConfigFile,optGuideFile)
-if optLanguage != "en":
-    guide.lang = optLanguage
-
-if args.findid is not None and args.findid:
-    for zipCode in loadZipCodes():
-        zipCode = str(zipCode)
-        #strip whitespace
-        zipCode = zipCode.strip()
-        logging.info("Finding IDs for: %s", zipCode)
-        guide.FindID(zipCode)
-    sys.exit()
-if args.channels is not None and args.channels:
-    guide.showAvailableChannels()
-    sys.exit()
-if args.web is not None and args.web:
-    import http.server
-    import socketserver
-    import threading
-    PORT = 9000
-    class httpHandler(http.server.SimpleHTTPRequestHandler):
-        def do_GET(self):
-            if self.path == '/xmlguide.xmltv':
-                self.send_response(200)
-                self.send_header("Content-type","text/xml")
-                self.end_headers()
-                with open(optGuideFile,"rb") as file:
-                    self.wfile.write(file.read())
-            elif self.path == '/health':
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(b'OK')
-            else:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(b"404 Not Found")
+if __name__ == "__main__":
+    optConfigFile = './zap2itconfig.ini'
+    optGuideFile = 'xmlguide.xmltv'
+    optLanguage = 'en'
 
-    Handler = httpHandler
-    with socketserver.TCPServer(("",PORT),Handler) as httpd:
-        logging.info("Serving at port %s",PORT)
-        
-        def guide_data_needs_refresh():
-            try:
-                mod_time = os.path.getmtime(optGuideFile)
-                mod_datetime = datetime.datetime.fromtimestamp(mod_time)
 
-                now = datetime.datetime.now()
-                time_diff = now - mod_datetime
+    parser = argparse.ArgumentParser("Parse Zap2it Guide into XMLTV")
+    parser.add_argument("-c","--configfile","-i","--ifile", help='Path to config file')
+    parser.add_argument("-o","--outputfile","--ofile", help='Path to output file')
+    parser.add_argument("-l","--language", help='Language')
+    parser.add_argument("-f","--findid", action="store_true", help='Find Headendid / lineupid')
+    parser.add_argument("-C","--channels", action="store_true", help='List available channels')
+    parser.add_argument("-w","--web", action="store_true", help="Start a webserver at http://localhost:9000 to serve /xmlguide.xmltv")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the grid response cache")
+    parser.add_argument("--profile", metavar="FILE", help="Write cProfile statistics for a one-shot build to FILE")
+    parser.add_argument("--refresh-window", action="append", type=ParseRefreshTime, metavar="TIME", help="Refetch the grid window containing TIME (epoch seconds or ISO date), may be repeated")
 
-                if time_diff > datetime.timedelta(hours=24):
-                    logging.info("Guide is older than 24 hours.")
-                    return True
+    args = parser.parse_args()
+    logging.info("%s", args)
+    if args.configfile is not None:
+        optConfigFile = args.configfile
+    if args.outputfile is not None:
+        optGuideFile = args.outputfile
+    if args.language is not None:
+        optLanguage = args.language
+
+    guide = Zap2ItGuideScrape(optConfigFile,optGuideFile)
+    #With named lineups configured every profile gets its own guide; otherwise the config is the only lineup
+    profiles = guide.LoadProfiles() or [guide]
+    guide.session.shareWindows = len(profiles) > 1
+    if optLanguage != "en":
+        for profile in profiles:
+            profile.lang = optLanguage
+    if args.no_cache:
+        guide.session.cache = None
+    if args.refresh_window is not None:
+        guide.session.refreshWindows.extend(args.refresh_window)
+
+    if args.findid is not None and args.findid:
+        for zipCode in loadZipCodes(guide.settings):
+            logging.info("Finding IDs for: %s", zipCode)
+            guide.FindID(zipCode)
+        guide.session.http.LogStats()
+        sys.exit()
+    if args.channels is not None and args.channels:
+        guide.showAvailableChannels()
+        sys.exit()
+    if args.web is not None and args.web:
+        import http.server
+        PORT = 9000
+        guideStore = GuideStore()
+        #The server loads and indexes the plain XMLTV guide, whatever else is written alongside it
+        for profile in profiles:
+            if "xmltv" not in profile.outputFormats:
+                profile.outputFormats.insert(0, "xmltv")
+        #Artwork is served from /art/ once fetched; the guides point there from the next build on
+        artCache = None
+        if guide.settings.artEnabled and not guide.settings.artUrl:
+            #A guessed address such as localhost would hand remote clients icons they cannot load
+            logging.warning("Artwork cache disabled: [art] url must be set to the address clients use to reach this server")
+        elif guide.settings.artEnabled:
+            artCache = ArtCache(guide.settings.artDir, guide.settings.artMaxSize, guide.settings.artFetchers, guide.settings.timeout)
+            for profile in profiles:
+                profile.artCache = artCache
+                profile.artBase = guide.settings.artUrl
+        #The first lineup is also served at the original /xmlguide.xmltv location
+        guidePaths = {}
+        for profile in profiles:
+            guidePaths[profile] = []
+            if profile.profile is not None:
+                guidePaths[profile].append('/lineups/' + profile.profile + '.xmltv')
+            if profile is profiles[0]:
+                guidePaths[profile].append('/xmlguide.xmltv')
+            for path in guidePaths[profile]:
+                guideStore.Register(path)
+        #Queries against each lineup's index: /lineups/<name>/now etc., and /now etc. for the first lineup
+        queryPaths = {}
+        for profile in profiles:
+            prefixes = []
+            if profile.profile is not None:
+                prefixes.append('/lineups/' + profile.profile + '/')
+            if profile is profiles[0]:
+                prefixes.append('/')
+            for prefix in prefixes:
+                for query in ('guide.xmltv', 'now', 'next'):
+                    queryPaths[prefix + query] = (guidePaths[profile][0], query)
+        class httpHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                self.Respond(True)
+            def do_HEAD(self):
+                self.Respond(False)
+            def Respond(self, sendBody):
+                url = urllib.parse.urlsplit(self.path)
+                path = url.path
+                if guideStore.Has(path):
+                    self.SendGuide(guideStore.Get(path), "text/xml", sendBody)
+                elif path in queryPaths:
+                    guidePath, query = queryPaths[path]
+                    self.SendQuery(guideStore.Get(guidePath), query, urllib.parse.parse_qs(url.query), sendBody)
+                elif path == '/health':
+                    self.SendData(200, "text/plain", b'OK', sendBody)
+                elif artCache is not None and path.startswith('/art/'):
+                    self.SendArt(path[5:], sendBody)
+                elif path == '/metrics':
+                    self.SendData(200, "text/plain; version=0.0.4; charset=utf-8", guide.session.metrics.Render(), sendBody)
+                else:
+                    self.SendData(404, "text/plain", b"404 Not Found", sendBody)
+            def SendQuery(self, served, query, parameters, sendBody):
+                if served is None:
+                    self.SendGuide(None, "text/plain", sendBody)
+                    return
+                try:
+                    channelIds = None
+                    if "channels" in parameters:
+                        channelIds = [channelId.strip() for value in parameters["channels"] for channelId in value.split(",") if channelId.strip()]
+                    if query == "guide.xmltv":
+                        start = ParseQueryTime(parameters["start"][0]) if "start" in parameters else None
+                        end = ParseQueryTime(parameters["end"][0]) if "end" in parameters else None
+                        if "hours" in parameters:
+                            #"The next N hours" when no start is given
+                            if start is None:
+                                start = time.time()
+                            end = start + float(parameters["hours"][0]) * 3600
+                        self.SendGuide(served.index.Guide(channelIds, start, end), "text/xml", sendBody)
+                    else:
+                        at = ParseQueryTime(parameters["at"][0]) if "at" in parameters else time.time()
+                        self.SendGuide(served.index.Airing(channelIds, at, query == "next"), "application/json", sendBody)
+                except ValueError as e:
+                    self.SendData(400, "text/plain", str(e).encode("utf8"), sendBody)
+            def SendArt(self, name, sendBody):
+                artId, _, extension = name.partition(".")
+                art = artCache.Get(artId) if extension == "jpg" else None
+                if art is None:
+                    #Not stored and not fetchable right now: send the client to the original
+                    url = artCache.Url(artId) if extension == "jpg" else None
+                    if url is None:
+                        self.SendData(404, "text/plain", b"404 Not Found", sendBody)
+                    else:
+                        self.SendData(302, "text/plain", b"", sendBody, {"Location": url, "Cache-Control": "no-cache"})
+                    return
+                data, digest, contentType = art
+                #An id always names the same image, so clients can keep it for good
+                headers = {"ETag": '"' + digest + '"', "Cache-Control": "public, max-age=31536000, immutable"}
+                ifNoneMatch = self.headers.get("If-None-Match")
+                if ifNoneMatch is not None and headers["ETag"] in [tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")]:
+                    self.send_response(304)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+                self.SendData(200, contentType, data, sendBody, headers)
+            def SendData(self, status, contentType, data, sendBody, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if sendBody:
+                    self.wfile.write(data)
+            def NotModified(self, served):
+                ifNoneMatch = self.headers.get("If-None-Match")
+                if ifNoneMatch is not None:
+                    tags = [tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")]
+                    return "*" in tags or served.etag in tags or served.gzipEtag in tags
+                ifModifiedSince = self.headers.get("If-Modified-Since")
+                if ifModifiedSince is not None:
+                    try:
+                        return served.mtime <= email.utils.parsedate_to_datetime(ifModifiedSince).timestamp()
+                    except (TypeError, ValueError):
+                        return False
+                return False
+            def ParseRange(self, served):
+                #Single byte ranges only; anything else falls back to the full body
+                rangeHeader = self.headers.get("Range")
+                if rangeHeader is None or not rangeHeader.startswith("bytes=") or "," in rangeHeader:
+                    return None
+                ifRange = self.headers.get("If-Range")
+                if ifRange is not None and ifRange != served.etag and ifRange != served.lastModified:
+                    return None
+                first, _, last = rangeHeader[6:].strip().partition("-")
+                size = len(served.data)
+                try:
+                    if first == "":
+                        start = max(0, size - int(last))
+                        end = size - 1
+                    else:
+                        start = int(first)
+                        end = min(size - 1, int(last)) if last != "" else size - 1
+                except ValueError:
+                    return None
+                if start > end or start >= size:
+                    return (None, None)
+                return (start, end)
+            def SendGuide(self, served, contentType, sendBody):
+                if served is None:
+                    self.SendData(503, "text/plain", b"Guide is not available yet", sendBody, {"Retry-After": "60"})
+                    return
+                headers = {
+                    "Last-Modified": served.lastModified,
+                    "Cache-Control": "no-cache",
+                    "Accept-Ranges": "bytes",
+                    "Vary": "Accept-Encoding"
+                }
+                useGzip = AcceptsGzip(self.headers.get("Accept-Encoding"))
+                if self.NotModified(served):
+                    headers["ETag"] = served.gzipEtag if useGzip else served.etag
+                    self.send_response(304)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+                byteRange = self.ParseRange(served)
+                if byteRange == (None, None):
+                    headers["Content-Range"] = "bytes */%d" % len(served.data)
+                    self.SendData(416, "text/plain", b"", sendBody, headers)
+                elif byteRange is not None:
+                    start, end = byteRange
+                    headers["ETag"] = served.etag
+                    headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(served.data))
+                    self.SendData(206, contentType, served.data[start:end + 1], sendBody, headers)
+                elif useGzip:
+                    headers["ETag"] = served.gzipEtag
+                    headers["Content-Encoding"] = "gzip"
+                    self.SendData(200, contentType, served.GzipData(), sendBody, headers)
                 else:
-                    logging.info("Guide was generated within the last 24 hours.")
-                    return False
+                    headers["ETag"] = served.etag
+                    self.SendData(200, contentType, served.data, sendBody, headers)
 
-            except FileNotFoundError:
-                logging.info("Guide data does not exist.")
-                return True
-        
-        def run_guide_build():
-            while True:
+        Handler = httpHandler
+        with http.server.ThreadingHTTPServer(("",PORT),Handler) as httpd:
+            logging.info("Serving at port %s",PORT)
+
+            def guide_data_needs_refresh(profile):
                 try:
-                    if guide_data_needs_refresh():
-                        guide.BuildGuide()
-                        logging.info("Guide Refreshed")
+                    mod_time = os.path.getmtime(profile.outputFile)
+                    mod_datetime = datetime.datetime.fromtimestamp(mod_time)
+
+                    now = datetime.datetime.now()
+                    time_diff = now - mod_datetime
+
+                    if profile.missingWindows and time_diff > datetime.timedelta(seconds=profile.settings.partialRetry):
+                        logging.info("Guide is missing %d windows, retrying them.", len(profile.missingWindows))
+                        return True
+
+                    if profile.incremental:
+                        if time_diff > datetime.timedelta(seconds=profile.refreshInterval):
+                            logging.info("Guide is due for an incremental refresh.")
+                            return True
+                        return False
+
+                    if time_diff > datetime.timedelta(hours=24):
+                        logging.info("Guide is older than 24 hours.")
+                        return True
                     else:
-                        logging.info("Guide Is Still Valid")
-                except Exception as err:
-                    print(f"Error Refreshing Guide: {err}")
-                time.sleep(60)  
+                        logging.info("Guide was generated within the last 24 hours.")
+                        return False
+
+                except FileNotFoundError:
+                    logging.info("Guide data does not exist.")
+                    return True
+
+            def run_guide_build():
+                #One scheduler for every lineup: builds run one after another, spaced out by lineupStagger
+                while True:
+                    built = False
+                    for profile in profiles:
+                        try:
+                            if guide_data_needs_refresh(profile):
+                                if built:
+                                    time.sleep(guide.settings.lineupStagger)
+                                profile.BuildGuide()
+                                built = True
+                                guideStore.Load(guidePaths[profile], profile.outputFile)
+                                logging.info("Guide Refreshed")
+                                if artCache is not None:
+                                    artCache.Prefetch(profile.artUrls)
+                            else:
+                                if guideStore.Get(guidePaths[profile][0]) is None:
+                                    guideStore.Load(guidePaths[profile], profile.outputFile)
+                                    #A guide left by an earlier run still reports its age
+                                    guide.session.metrics.set("zap2it_guide_last_success_timestamp_seconds",
+                                        {"lineup": profile.lineupName}, guideStore.Get(guidePaths[profile][0]).mtime)
+                                logging.info("Guide Is Still Valid")
+                        except Exception as err:
+                            guide.session.metrics.add("zap2it_guide_build_failures_total", {"lineup": profile.lineupName})
+                            print(f"Error Refreshing Guide: {err}")
+                    guide.session.EndCycle()
+                    time.sleep(60)  
 
-        guide_thread = threading.Thread(target=run_guide_build)
-        guide_thread.daemon = True
-        guide_thread.start()
-        httpd.serve_forever()
+            guide_thread = threading.Thread(target=run_guide_build)
+            guide_thread.daemon = True
+            guide_thread.start()
+            httpd.serve_forever()
 
 
-guide.BuildGuide()
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        for profile in profiles:
+            profile.inlineFetch = True
+        profiler.enable()
+    for profile in profiles:
+        profile.BuildGuide()
+    guide.session.EndCycle()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        logging.info("Profile written to %s (python -m pstats %s)", args.profile, args.profile)
 
 